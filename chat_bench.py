@@ -0,0 +1,289 @@
+"""Load generator and latency benchmark for the chat servers.
+
+Opens many connections to a chat server, logs them in, sends messages
+at a fixed rate from some of them and measures the throughput and the
+end-to-end latency of the broadcasts. The messages carry their send
+time, "msg bench:<nanoseconds>\\n", so any server that passes the
+message text through can be measured:
+
+    python chat_bench.py -s complete     # chat_complete.serve
+    python chat_bench.py -s simple       # chat_simple.serve
+    python chat_bench.py HOST PORT       # running server
+"""
+
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass
+import importlib
+import multiprocessing as mp
+import sys
+import time
+
+import eventloops
+from metrics import Histogram
+
+
+CONNECTIONS = 1000
+SENDERS = 10
+RATE = 1000.0
+DURATION = 10.0
+READ_SIZE = 64 * 1024
+CONNECT_BATCH = 100
+
+
+@dataclass
+class Report:
+    """Benchmark results."""
+
+    connections: int
+    setup_time: float
+    sent: int
+    send_time: float
+    received: int
+    receive_time: float
+    latency: Histogram
+
+    @property
+    def expected(self) -> int:
+        """Messages that should have been received, all by every client."""
+        return self.sent * self.connections
+
+    def __str__(self) -> str:
+        latency = self.latency
+        expected = self.expected
+        lost = (expected - self.received) / expected if expected else 0.0
+        return "\n".join(
+            [
+                f"connections: {self.connections} "
+                f"({self.connections / self.setup_time:.0f}/s)",
+                f"sent: {self.sent} ({self.sent / self.send_time:.0f}/s)",
+                f"received: {self.received} of {expected} "
+                f"({self.received / self.receive_time:.0f}/s, "
+                f"{lost:.2%} undelivered)",
+                f"latency: p50 {latency.percentile(50) / 1e6:.2f} ms, "
+                f"p99 {latency.percentile(99) / 1e6:.2f} ms, "
+                f"p999 {latency.percentile(99.9) / 1e6:.2f} ms, "
+                f"max {latency.max / 1e6:.2f} ms",
+            ]
+        )
+
+
+async def _connect(
+    host: str, port: int, num: int
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"login bench%d\n" % num)
+    return reader, writer
+
+
+async def bench(
+    host: str,
+    port: int,
+    connections: int = CONNECTIONS,
+    senders: int = SENDERS,
+    rate: float = RATE,
+    duration: float = DURATION,
+) -> Report:
+    """Benchmark chat server at `host`, `port`.
+
+    `connections` clients are connected, of which `senders` send `rate`
+    messages per second, in total, for `duration` seconds. Every client
+    should receive every message.
+    """
+    # connect
+    start_time = time.perf_counter()
+    streams = []
+
+    for first in range(0, connections, CONNECT_BATCH):
+        last = min(first + CONNECT_BATCH, connections)
+        streams.extend(
+            await asyncio.gather(
+                *(_connect(host, port, num) for num in range(first, last))
+            )
+        )
+
+    setup_time = time.perf_counter() - start_time
+
+    # let the server handle the logins
+    await asyncio.sleep(0.5)
+
+    # receive
+    latency = Histogram()
+    received = 0
+    done = asyncio.Event()
+    expected: int | None = None
+    bench_start = time.time_ns()
+
+    async def receive(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        nonlocal received
+        rest = b""
+
+        while data := await reader.read(READ_SIZE):
+            now = time.time_ns()
+            data = rest + data
+            end = data.rfind(b"\n")
+            rest = data[end + 1 :]
+
+            for line in data[:end].split(b"\n"):
+                pos = line.find(b"bench:")
+
+                if pos < 0:
+                    if line == b"ping":
+                        writer.write(b"pong\n")
+
+                    continue
+
+                try:
+                    sent_time = int(line[pos + 6 :])
+                except ValueError:
+                    continue
+
+                # skip messages from before this benchmark, e.g. history
+                if sent_time >= bench_start:
+                    latency.record(now - sent_time)
+                    received += 1
+
+            if expected is not None and received >= expected:
+                done.set()
+
+    receivers = [
+        asyncio.create_task(receive(reader, writer)) for reader, writer in streams
+    ]
+
+    # send, evenly spread over the senders
+    async def send(writer: asyncio.StreamWriter, sender_rate: float) -> int:
+        sent = 0
+        start = time.perf_counter()
+
+        while (elapsed := time.perf_counter() - start) < duration:
+            due = int(elapsed * sender_rate)
+
+            if due > sent:
+                writer.writelines(
+                    [b"msg bench:%d\n" % time.time_ns()] * (due - sent)
+                )
+                sent = due
+                await writer.drain()
+
+            await asyncio.sleep(0.001)
+
+        return sent
+
+    senders = min(senders, connections)
+    start_time = time.perf_counter()
+    sent = sum(
+        await asyncio.gather(
+            *(send(writer, rate / senders) for _, writer in streams[:senders])
+        )
+    )
+    send_time = time.perf_counter() - start_time
+
+    # wait for the stragglers, but not forever
+    expected = sent * connections
+
+    if received < expected:
+        try:
+            await asyncio.wait_for(done.wait(), max(duration, 1.0))
+        except asyncio.TimeoutError:
+            pass
+
+    receive_time = time.perf_counter() - start_time
+
+    for task in receivers:
+        task.cancel()
+
+    for _, writer in streams:
+        writer.close()
+
+    return Report(
+        connections, setup_time, sent, send_time, received, receive_time, latency
+    )
+
+
+def _serve(module_name: str, host: str, port: int) -> None:
+    module = importlib.import_module(module_name)
+    eventloops.run(module.serve(host, port))
+
+
+async def main() -> None:
+    """Program entry point."""
+    # parse arguments
+    prog, *args = sys.argv
+    usage = (
+        f"usage: {prog} [-l LOOP] [-c CONNECTIONS] [-n SENDERS] [-r RATE] "
+        "[-d SECONDS] (-s complete|simple | HOST PORT)"
+    )
+    options = {"-c": CONNECTIONS, "-n": SENDERS, "-r": RATE, "-d": DURATION}
+
+    for option, default in options.items():
+        try:
+            pos = args.index(option)
+        except ValueError:
+            continue
+
+        try:
+            options[option] = type(default)(args[pos + 1])
+        except (IndexError, ValueError):
+            sys.exit(usage)
+
+        del args[pos : pos + 2]
+
+    try:
+        pos = args.index("-s")
+    except ValueError:
+        server = None
+    else:
+        try:
+            server = {"complete": "chat_complete", "simple": "chat_simple"}[
+                args[pos + 1]
+            ]
+        except (IndexError, KeyError):
+            sys.exit(usage)
+
+        del args[pos : pos + 2]
+
+    if server is not None and not args:
+        host = "localhost"
+        port = eventloops.free_port(host)
+    elif server is None and len(args) == 2 and args[1].isdigit():
+        host, port = args[0], int(args[1])
+    else:
+        sys.exit(usage)
+
+    # start server, in a process of its own
+    if server is not None:
+        process = mp.get_context("spawn").Process(
+            target=_serve, args=(server, host, port), daemon=True
+        )
+        process.start()
+
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(host, port)
+            except ConnectionRefusedError:
+                await asyncio.sleep(0.1)
+            else:
+                writer.close()
+                break
+
+    # run benchmark
+    try:
+        report = await bench(
+            host,
+            port,
+            connections=int(options["-c"]),
+            senders=int(options["-n"]),
+            rate=options["-r"],
+            duration=options["-d"],
+        )
+    finally:
+        if server is not None:
+            process.terminate()
+
+    print(report)
+
+
+if __name__ == "__main__":
+    eventloops.run(main())
@@ -6,99 +6,144 @@ implemented:
 client -> server:
 
     login <username>\n
+    join <room>\n
     msg <msg>\n
+    pong\n
 
 server -> client:
 
     msg <username> <timestamp> <msg>\n
+    ping\n
 
-Messages should be broadcast to all connected clients!
+Messages should be broadcast to all connected clients in the same
+room! Clients start out in the "lobby" room. The latest messages in
+a room are sent to clients when they enter it.
+
+The server may ping clients that have been idle for a while, they
+should reply with pong, and disconnect clients idle for too long.
 """
 
 from __future__ import annotations
 import asyncio
+from collections import Counter, abc, deque
 from contextlib import contextmanager
 from dataclasses import dataclass
-import re
+from enum import Enum
+from functools import partial
+import math
+import mmap
+import multiprocessing as mp
+import os
+import socket
 import sys
+import tempfile
 import time
-from typing import ClassVar, Generator, Pattern
+from typing import Any, Generator, Protocol, cast
+
+from console import input_line, stdin_chunks
+import eventloops
+from metrics import Metrics, serve_metrics
 
 
 HOST = "localhost"
 PORT = 21213
+QUEUE_SIZE = 1024
+BATCH_SIZE = 64
+HISTORY_SIZE = 100
+HISTORY_ROOMS = 1024
+HISTORY_LOG_SIZE = 1024 * 1024
+TICK = 1.0
+WHEEL_SLOTS = 512
+LOBBY = "lobby"
+BUS_LIMIT = 1024 * 1024
+
+
+READ_SIZE = 64 * 1024
+LINE_LIMIT = 64 * 1024
+
+
+def _is_word(data: bytes) -> bool:
+    """Check whether `data` is non-empty and ASCII letters, digits and _."""
+    return data.replace(b"_", b"a").isalnum()
+
+
+def _valid_utf8(data: bytes) -> bytes:
+    """Return `data` with invalid utf-8 replaced."""
+    if not data.isascii():
+        try:
+            data.decode()
+        except UnicodeDecodeError:
+            return data.decode(errors="replace").encode()
+
+    return data
 
 
 @dataclass
 class Login:
     """Login message."""
 
-    RE: ClassVar[Pattern[bytes]] = re.compile(rb"login (\w+)\n")
-
     user: str
 
     @classmethod
-    def from_client(cls, line: bytes) -> Login | None:
-        """Construct `cls` from `line`."""
-        match = cls.RE.match(line)
+    def parse(cls, content: bytes) -> Login | None:
+        """Construct `cls` from a line's `content`, see `ClientDecoder`."""
+        user = content[6:]
 
-        if not match:
+        if content[:6] != b"login " or not _is_word(user):
             return None
 
-        (user,) = match.groups()
+        return cls(user=user.decode())
 
-        try:
-            return cls(user=user.decode())
-        except UnicodeDecodeError:
+    def to_bytes(self) -> bytes:
+        """Return wire format."""
+        return b"login %s\n" % (self.user.encode())
+
+
+@dataclass
+class Join:
+    """Join room message."""
+
+    room: str
+
+    @classmethod
+    def parse(cls, content: bytes) -> Join | None:
+        """Construct `cls` from a line's `content`, see `ClientDecoder`."""
+        room = content[5:]
+
+        if content[:5] != b"join " or not _is_word(room):
             return None
 
+        return cls(room=room.decode())
+
     def to_bytes(self) -> bytes:
         """Return wire format."""
-        return b"login %s\n" % (self.user.encode())
+        return b"join %s\n" % (self.room.encode())
 
 
 @dataclass
 class Msg:
     """Message message."""
 
-    SERVER_RE: ClassVar[Pattern[bytes]] = re.compile(rb"msg (.*)\n")
-    CLIENT_RE: ClassVar[Pattern[bytes]] = re.compile(rb"msg (\w+) (\d+) (.*)\n")
-
     user: str
     timestamp: int
     text: str
 
     @classmethod
-    def from_client(cls, user: str, line: bytes) -> Msg | None:
-        """Construct `cls` from `user` and `line`."""
-        match = cls.SERVER_RE.match(line)
-
-        if not match:
+    def parse(cls, content: bytes) -> Msg | None:
+        """Construct `cls` from a line's `content`, see `ServerDecoder`."""
+        if content[:4] != b"msg ":
             return None
 
-        return cls(
-            user=user,
-            timestamp=int(time.time()),
-            text=match.group(1).decode(errors="replace"),
-        )
-
-    @classmethod
-    def from_server(cls, line: bytes) -> Msg | None:
-        """Construct `cls` from `line`."""
-        match = cls.CLIENT_RE.match(line)
-
-        if not match:
+        try:
+            user, timestamp, text = content[4:].split(b" ", 2)
+        except ValueError:
             return None
 
-        user, timestamp, text = match.groups()
-
-        try:
-            user = user.decode()
-        except UnicodeDecodeError:
+        if not _is_word(user) or not timestamp.isdigit():
             return None
 
         return cls(
-            user=user,
+            user=user.decode(),
             timestamp=int(timestamp),
             text=text.decode(errors="replace"),
         )
@@ -112,55 +157,1433 @@ class Msg:
         )
 
 
-async def serve(host: str, port: int) -> None:
-    """Serve chat server."""
-    clients: list[asyncio.StreamWriter] = []
+@dataclass
+class Ping:
+    """Heartbeat request."""
+
+    def to_bytes(self) -> bytes:
+        """Return wire format."""
+        return b"ping\n"
+
+
+@dataclass
+class Pong:
+    """Heartbeat reply."""
+
+    def to_bytes(self) -> bytes:
+        """Return wire format."""
+        return b"pong\n"
+
+
+class _LineDecoder:
+    """Incremental line splitter, lines are returned without newline."""
+
+    def __init__(self, limit: int = LINE_LIMIT) -> None:
+        self.limit = limit
+        self._rest = b""
+
+    def _lines(self, data: bytes) -> list[bytes]:
+        if self._rest:
+            data = self._rest + data
+
+        end = data.rfind(b"\n")
+        self._rest = data[end + 1 :]
+
+        if len(self._rest) > self.limit:
+            raise ValueError("line too long")
+
+        return data[:end].split(b"\n") if end >= 0 else []
+
+
+class ClientDecoder(_LineDecoder):
+    """Incremental decoder of client -> server frames.
+
+    `feed` returns the frames completed by the data: `Login`, `Join`
+    and `Pong` messages, server wire format of messages from the logged
+    in user, passed through as bytes rather than decoded to `Msg` and
+    encoded again, and None for invalid frames.
+
+    >>> decoder = ClientDecoder(limit=16)
+    >>> decoder.feed(b"login ada\\nms")
+    [Login(user='ada')]
+    >>> decoder.feed(b"g hi\\njoin dev\\npong\\nbad\\n")  # doctest: +ELLIPSIS
+    [b'msg ada ... hi\\n', Join(room='dev'), Pong(), None]
+    >>> decoder.feed(b"msg " + b"a" * 16)
+    Traceback (most recent call last):
+    ...
+    ValueError: line too long
+    """
+
+    def __init__(self, limit: int = LINE_LIMIT) -> None:
+        super().__init__(limit)
+        self.user: bytes | None = None
+
+    def feed(self, data: bytes) -> list[Login | Join | Pong | bytes | None]:
+        """Decode `data`, raises ValueError if a line exceeds `limit`."""
+        frames: list[Login | Join | Pong | bytes | None] = []
+        append = frames.append
+        user = self.user
+        timestamp = int(time.time())
+
+        for content in self._lines(data):
+            if content[:4] == b"msg " and user is not None:
+                append(b"msg %s %d %s\n" % (user, timestamp, _valid_utf8(content[4:])))
+            elif content[:5] == b"join ":
+                append(Join.parse(content))
+            elif content == b"pong":
+                append(Pong())
+            else:
+                login = Login.parse(content)
+
+                if login is not None and user is None:
+                    user = self.user = login.user.encode()
+
+                append(login)
+
+        return frames
+
+
+class ServerDecoder(_LineDecoder):
+    """Incremental decoder of server -> client frames.
+
+    `feed` returns the `Msg` and `Ping` messages completed by the data,
+    or None for invalid frames.
+
+    >>> decoder = ServerDecoder()
+    >>> decoder.feed(b"msg ada 1700000000 hi\\npi")
+    [Msg(user='ada', timestamp=1700000000, text='hi')]
+    >>> decoder.feed(b"ng\\nmsg ada\\n")
+    [Ping(), None]
+    """
+
+    def feed(self, data: bytes) -> list[Msg | Ping | None]:
+        """Decode `data`, raises ValueError if a line exceeds `limit`."""
+        return [
+            Ping() if content == b"ping" else Msg.parse(content)
+            for content in self._lines(data)
+        ]
+
+
+class Overflow(Enum):
+    """What to do when a client's send queue is full.
+
+    DROP_OLDEST drops the oldest queued message, DISCONNECT disconnects
+    the client and COALESCE drops the oldest queued message from the
+    same user, so the latest message of every user is kept (or the
+    oldest message if there is none from that user).
+
+    >>> queue = deque([("ada", b"1"), ("bob", b"2")])
+    >>> _enqueue(queue, 2, Overflow.COALESCE, "bob", b"3"), list(queue)
+    (True, [('ada', b'1'), ('bob', b'3')])
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    DISCONNECT = "disconnect"
+    COALESCE = "coalesce"
+
+
+def _enqueue(
+    queue: deque[tuple[str, bytes]],
+    maxsize: int,
+    overflow: Overflow,
+    user: str,
+    data: bytes,
+) -> bool:
+    """Append `data`, a message from `user`, to `queue`.
+
+    Returns False, without appending, if the client should rather be
+    disconnected according to `overflow`.
+    """
+    if len(queue) >= maxsize:
+        if overflow is Overflow.DISCONNECT:
+            return False
+
+        if overflow is Overflow.COALESCE:
+            for pos, (queued_user, _) in enumerate(queue):
+                if queued_user == user:
+                    del queue[pos]
+                    break
+            else:
+                queue.popleft()
+        else:
+            queue.popleft()
+
+    queue.append((user, data))
+    return True
+
+
+def _set_nodelay(transport: asyncio.BaseTransport) -> None:
+    """Disable Nagle's algorithm on TCP `transport`.
+
+    Messages are coalesced by the send queues, which write a whole batch
+    with one call, so the kernel should send it right away rather than
+    wait for more data (or for TCP_CORK to be removed).
+    """
+    sock = transport.get_extra_info("socket")
+
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class Recipient(Protocol):
+    """Connected client as seen by `Registry`."""
+
+    room: str | None
+    active: float
+
+    @property
+    def queued(self) -> int:
+        """Number of messages queued."""
+
+    @property
+    def delayed(self) -> bool:
+        """Whether reading from the client is held back."""
+
+    def send(self, user: str, data: bytes) -> None:
+        """Send `data`, a message from `user`, without blocking."""
+
+    def replay(self, frames: list[bytes]) -> None:
+        """Send `frames`, earlier messages, after the messages sent so far."""
+
+    def close(self) -> None:
+        """Disconnect client."""
+
+
+class _Outbox:
+    """Send side of a connection, writing to `_transport`.
+
+    Messages are written as they are sent unless writing is paused, then
+    they are queued, in a queue bounded by `maxsize` (see `Overflow`),
+    until it is resumed, so slow clients never hold up senders.
+
+    If `batch_delay` is non-zero, messages are queued and written after
+    at most `batch_delay` seconds, or as soon as `batch_size` messages
+    are queued, so that bursts of messages are written together.
+    """
+
+    _transport: asyncio.WriteTransport
+
+    def __init__(
+        self, maxsize: int, overflow: Overflow, batch_size: int, batch_delay: float
+    ) -> None:
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue: deque[tuple[str, bytes]] = deque()
+        self._paused = False
+        self._closed = False
+        self._flush: asyncio.TimerHandle | None = None
+
+    @property
+    def queued(self) -> int:
+        """Number of messages queued."""
+        return len(self._queue)
+
+    def send(self, user: str, data: bytes) -> None:
+        """Send `data`, a message from `user`, without blocking."""
+        if self._closed:
+            return
+
+        if not self._paused and not self.batch_delay:
+            self._transport.write(data)
+            self._written()
+        elif not _enqueue(self._queue, self.maxsize, self.overflow, user, data):
+            self.close()
+        elif self._paused:
+            pass
+        elif len(self._queue) >= self.batch_size:
+            self._write_queued()
+        elif self._flush is None:
+            loop = asyncio.get_running_loop()
+            self._flush = loop.call_later(self.batch_delay, self._write_queued)
+
+    def _cancel_flush(self) -> None:
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+
+    def replay(self, frames: list[bytes]) -> None:
+        """Write `frames`, earlier messages, after the queued messages.
+
+        The frames are written at once unless writing is paused, then
+        they are queued like sent messages, subject to `overflow`.
+        """
+        if not frames or self._closed:
+            return
+
+        if self._paused:
+            for data in frames:
+                if not _enqueue(self._queue, self.maxsize, self.overflow, "", data):
+                    self.close()
+                    return
+        else:
+            self._cancel_flush()
+            self._transport.writelines([data for _, data in self._queue] + frames)
+            self._queue.clear()
+            self._written()
+
+    def _write_queued(self) -> None:
+        self._cancel_flush()
+
+        if self._queue and not self._paused:
+            self._transport.writelines([data for _, data in self._queue])
+            self._queue.clear()
+            self._written()
+
+    def _written(self) -> None:
+        """Called after writing to the transport."""
+
+    def close(self) -> None:
+        """Disconnect client, discarding anything not yet sent."""
+        self._queue.clear()
+        self._cancel_flush()
+
+        # rather than wait for a client that isn't reading to drain
+        self._transport.abort()
+
+        # send nothing more, even before the connection is lost
+        self._closed = True
+
+
+class Client(_Outbox):
+    """Connected client.
+
+    Messages are written and queued as described in `_Outbox`, writing
+    is paused when the writer's buffer is full, until a task of the
+    client's own has drained it.
+
+    The time spent waiting for writes to drain is recorded in the
+    "drain_ns" histogram of `metrics`, if given.
+    """
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        maxsize: int = QUEUE_SIZE,
+        overflow: Overflow = Overflow.DROP_OLDEST,
+        batch_size: int = BATCH_SIZE,
+        batch_delay: float = 0.0,
+        metrics: Metrics | None = None,
+    ) -> None:
+        super().__init__(maxsize, overflow, batch_size, batch_delay)
+        self.writer = writer
+        self.metrics = metrics
+        self.room: str | None = None
+        self.active = asyncio.get_running_loop().time()
+        self.delayed = False
+        self._transport = writer.transport
+        self._high_water = self._transport.get_write_buffer_limits()[1]
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._drain())
+
+    def _written(self) -> None:
+        # once the buffer is full, queue messages until it has drained
+        if self._transport.get_write_buffer_size() > self._high_water:
+            self._paused = True
+            self._ready.set()
+
+    async def _drain(self) -> None:
+        drain_ns = self.metrics.histogram("drain_ns") if self.metrics else None
+
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+
+                if drain_ns is None:
+                    await self.writer.drain()
+                else:
+                    start_time = time.perf_counter_ns()
+                    await self.writer.drain()
+                    drain_ns.record(time.perf_counter_ns() - start_time)
+
+                self._paused = False
+                self._write_queued()
+        except ConnectionError:
+            self.close()
+
+    def close(self) -> None:
+        """Disconnect client, discarding anything not yet sent."""
+        super().close()
+        self._task.cancel()
+
+
+class History:
+    """Latest messages by room.
+
+    The wire format frames of the latest `size` messages are kept in
+    ring buffers, for the `max_rooms` rooms with the latest messages.
+
+    If `path` is given, the history is read from the log file `path`,
+    and unless `read_only`, logged messages are appended to it as
+    "<room> <frame>" lines. The log is compacted to the kept history
+    when opened, and whenever it has grown to twice that size (or
+    `HISTORY_LOG_SIZE`), so reading it stays cheap.
+    """
+
+    def __init__(
+        self,
+        size: int = HISTORY_SIZE,
+        path: str | None = None,
+        max_rooms: int = HISTORY_ROOMS,
+        read_only: bool = False,
+    ) -> None:
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms: dict[str, deque[bytes]] = {}
+        self._path = path
+        self._pending: list[bytes] = []
+        self._fd: int | None = None
+        self._log_size = 0
+        self._compact_size = HISTORY_LOG_SIZE
+
+        if path is not None:
+            self._read_log(path)
+
+            if not read_only:
+                self._compact()
+
+    def _read_log(self, path: str) -> None:
+        try:
+            log_file = open(path, "rb")
+        except FileNotFoundError:
+            return
+
+        with log_file:
+            if not os.fstat(log_file.fileno()).st_size:  # can't be mapped
+                return
+
+            with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                for line in iter(log.readline, b""):
+                    room, sep, frame = line.partition(b" ")
+
+                    # skip torn and garbled lines
+                    if sep and frame[-1:] == b"\n" and _is_word(room):
+                        self.append(room.decode(), frame)
+
+    def _compact(self) -> None:
+        # rewrite the log with just the kept history
+        assert self._path is not None
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        data = b"".join(
+            b"%s %s" % (room.encode(), frame)
+            for room, frames in self.rooms.items()
+            for frame in frames
+        )
+
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(data)
+
+        os.replace(tmp_path, self._path)
+
+        if self._fd is not None:
+            os.close(self._fd)
+
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        self._log_size = len(data)
+        self._compact_size = max(2 * len(data), HISTORY_LOG_SIZE)
+
+    def append(self, room: str, data: bytes) -> None:
+        """Append `data`, a message frame, to the history of `room`."""
+        rooms = self.rooms
+
+        # rooms are kept in order of their latest message
+        frames = rooms.pop(room, None)
+
+        if frames is None:
+            frames = deque(maxlen=self.size)
+
+            if len(rooms) >= self.max_rooms:
+                del rooms[next(iter(rooms))]
+
+        rooms[room] = frames
+        frames.append(data)
+
+    def frames(self, room: str) -> list[bytes]:
+        """Return the message frames in the history of `room`, oldest first."""
+        return list(self.rooms.get(room, ()))
+
+    def log(self, room: str, data: bytes) -> None:
+        """Append `data`, a message frame in `room`, to the log file.
+
+        Messages are written together, once per event loop iteration.
+        """
+        if self._fd is None:
+            return
+
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        self._pending.append(b"%s %s" % (room.encode(), data))
+
+    def flush(self) -> None:
+        """Write logged messages to the log file."""
+        if self._pending and self._fd is not None:
+            data = b"".join(self._pending)
+            os.write(self._fd, data)
+            self._pending.clear()
+            self._log_size += len(data)
+
+            if self._log_size > self._compact_size:
+                self._compact()
+
+    def close(self) -> None:
+        """Flush and close the log file."""
+        self.flush()
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Flood(Enum):
+    """What to do with a message over the rate limit.
+
+    DROP drops the message, DELAY delays it, and reading further
+    messages from the client, until it is within the limit, and
+    DISCONNECT disconnects the client.
+    """
+
+    DROP = "drop"
+    DELAY = "delay"
+    DISCONNECT = "disconnect"
+
+
+class TokenBucket:
+    """Token bucket, holding up to `burst` tokens, refilled at `rate` per second.
+
+    >>> bucket = TokenBucket(rate=2, burst=3)
+    >>> now = bucket.time
+    >>> bucket.tokens -= 3
+    >>> bucket.delay(now), bucket.delay(now + 0.25), bucket.delay(now + 0.5)
+    (0.5, 0.25, 0.0)
+    >>> bucket.delay(now + 10), bucket.tokens
+    (0.0, 3)
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "time")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Return seconds from `now` until a token is available."""
+        tokens = self.tokens + (now - self.time) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.time = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Message rate limits per connection and per user.
+
+    Every connection may send `rate` messages per second, in bursts of
+    up to `burst` messages, and all connections of a user together
+    `user_rate` messages per second in bursts of `user_burst`. A rate of
+    None means no limit. See `Flood` for `action`.
+
+    The numbers of messages admitted, dropped, delayed (the number of
+    delays, really) and disconnected are counted.
+
+    The limits are kept in the server process, so with `serve_workers`
+    every worker limits its own connections, and a user connected to
+    several workers may send `user_rate` messages per second to each.
+    """
+
+    def __init__(
+        self,
+        rate: float | None = None,
+        burst: float | None = None,
+        user_rate: float | None = None,
+        user_burst: float | None = None,
+        action: Flood = Flood.DROP,
+    ) -> None:
+        self.rate = rate
+        self.burst = max(burst or rate or 1.0, 1.0)
+        self.user_rate = user_rate
+        self.user_burst = max(user_burst or user_rate or 1.0, 1.0)
+        self.action = action
+        self.admitted = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.disconnected = 0
+        self._users: dict[str, TokenBucket] = {}
+        self._connections: Counter[str] = Counter()
+        # release times of users without connections, oldest first
+        self._released: dict[str, float] = {}
+
+    def buckets(self, user: str) -> list[TokenBucket]:
+        """Return the token buckets of a new connection of `user`.
+
+        Call `release` when the connection is closed.
+        """
+        buckets = []
+
+        if self.rate:
+            buckets.append(TokenBucket(self.rate, self.burst))
+
+        if self.user_rate:
+            self._expire()
+            bucket = self._users.get(user)
+
+            if bucket is None:
+                bucket = self._users[user] = TokenBucket(
+                    self.user_rate, self.user_burst
+                )
+            else:
+                self._released.pop(user, None)
+
+            buckets.append(bucket)
+
+        self._connections[user] += 1
+        return buckets
+
+    def release(self, user: str) -> None:
+        """Forget a closed connection of `user`.
+
+        The bucket of a user without connections is kept until it would
+        have refilled, so reconnecting doesn't refill the burst.
+        """
+        self._connections[user] -= 1
+
+        if not self._connections[user]:
+            del self._connections[user]
+
+            if user in self._users:
+                self._released[user] = time.monotonic()
+                self._expire()
+
+    def _expire(self) -> None:
+        # forget the buckets released long enough ago to have refilled
+        assert self.user_rate
+        deadline = time.monotonic() - self.user_burst / self.user_rate
+        released = self._released
+
+        while released:
+            user = next(iter(released))
+
+            if released[user] > deadline:
+                break
+
+            del released[user], self._users[user]
+
+    def check(self, buckets: list[TokenBucket]) -> tuple[Flood | None, float]:
+        """Check a message limited by `buckets`, see `admit`.
+
+        Returns None and 0.0 if it is admitted, otherwise the `action`
+        to take, counted, and the seconds until it can be admitted.
+        """
+        delay = self.admit(buckets)
+
+        if not delay:
+            return None, 0.0
+
+        if self.action is Flood.DROP:
+            self.dropped += 1
+        elif self.action is Flood.DISCONNECT:
+            self.disconnected += 1
+        else:
+            self.delayed += 1
+
+        return self.action, delay
+
+    def admit(self, buckets: list[TokenBucket]) -> float:
+        """Admit a message limited by `buckets`.
+
+        Returns 0.0 if it is admitted, and a token is taken from every
+        bucket, otherwise the seconds until it can be admitted.
+        """
+        now = time.monotonic()
+        delay = 0.0
+
+        for bucket in buckets:
+            bucket_delay = bucket.delay(now)
+
+            if bucket_delay > delay:
+                delay = bucket_delay
+
+        if delay:
+            return delay
+
+        for bucket in buckets:
+            bucket.tokens -= 1
+
+        self.admitted += 1
+        return 0.0
+
+
+class TimerWheel:
+    """Hashed timer wheel.
+
+    Timers are hashed, by their deadline, to one of `slots` slots, the
+    wheel moving on to the next slot every `tick` seconds. Scheduling
+    and cancelling a timer is O(1), and a tick only looks at the timers
+    in one slot, so timers are cheap however many there are, at the
+    cost of firing up to `tick` seconds late.
+
+    >>> async def expired() -> tuple[list[str], list[str]]:
+    ...     wheel, expired = TimerWheel(tick=0.01, slots=4), []
+    ...     wheel.start()
+    ...     wheel.schedule("a", 0.01, partial(expired.append, "a"))
+    ...     wheel.schedule("a", 0.05, partial(expired.append, "a again"))
+    ...     wheel.schedule("b", 0.05, partial(expired.append, "b"))
+    ...     wheel.schedule("c", 0.25, partial(expired.append, "c"))
+    ...     wheel.cancel("b")
+    ...     await asyncio.sleep(0.15)
+    ...     early = list(expired)
+    ...     await asyncio.sleep(0.35)
+    ...     wheel.stop()
+    ...     return early, expired
+    >>> asyncio.run(expired())
+    (['a again'], ['a again', 'c'])
+    """
+
+    def __init__(self, tick: float = TICK, slots: int = WHEEL_SLOTS) -> None:
+        self.tick = tick
+        self._slots: list[dict[object, tuple[int, abc.Callable[[], object]]]] = [
+            {} for _ in range(slots)
+        ]
+        self._slot_of: dict[object, int] = {}
+        self._ticks = 0
+        self._start_time = 0.0
+        self._handle: asyncio.TimerHandle | None = None
+
+    def start(self) -> None:
+        """Start turning the wheel in the running event loop."""
+        loop = asyncio.get_running_loop()
+        self._start_time = loop.time() - self._ticks * self.tick
+        self._handle = loop.call_at(
+            self._start_time + (self._ticks + 1) * self.tick, self._advance
+        )
+
+    def stop(self) -> None:
+        """Stop turning the wheel."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def schedule(
+        self, key: object, delay: float, callback: abc.Callable[[], object]
+    ) -> None:
+        """Call `callback` in `delay` seconds, replacing the timer of `key`."""
+        self.cancel(key)
+        deadline = self._ticks + max(math.ceil(delay / self.tick), 1)
+        slot = deadline % len(self._slots)
+        self._slots[slot][key] = (deadline, callback)
+        self._slot_of[key] = slot
+
+    def cancel(self, key: object) -> None:
+        """Cancel the timer of `key`, if any."""
+        slot = self._slot_of.pop(key, None)
+
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def _advance(self) -> None:
+        self._ticks += 1
+        loop = asyncio.get_running_loop()
+        self._handle = loop.call_at(
+            self._start_time + (self._ticks + 1) * self.tick, self._advance
+        )
+
+        ticks = self._ticks
+        timers = self._slots[ticks % len(self._slots)]
+        expired = [key for key, (deadline, _) in timers.items() if deadline <= ticks]
+
+        for key in expired:
+            _, callback = timers.pop(key)
+            del self._slot_of[key]
+            callback()
+
+
+class Registry:
+    """Connected clients by room."""
+
+    def __init__(self) -> None:
+        self.clients: set[Recipient] = set()
+        self.rooms: dict[str, set[Recipient]] = {}
+
+    def add(self, client: Recipient) -> None:
+        """Add `client` to the lobby."""
+        self.clients.add(client)
+        self.join(client, LOBBY)
+
+    def remove(self, client: Recipient) -> None:
+        """Remove and disconnect `client`."""
+        self._leave(client)
+        self.clients.discard(client)
+        client.close()
 
     @contextmanager
-    def register_client(writer: asyncio.StreamWriter) -> Generator[None, None, None]:
-        clients.append(writer)
+    def register(self, client: Recipient) -> Generator[None, None, None]:
+        """Register `client`, in the lobby, for the duration of the context."""
+        self.add(client)
         try:
             yield
         finally:
-            clients.remove(writer)
+            self.remove(client)
 
-    async def broadcast(msg: Msg) -> None:
-        data = msg.to_bytes()
+    def _leave(self, client: Recipient) -> None:
+        if client.room is None:
+            return
 
-        for writer in clients:
-            writer.write(data)
+        members = self.rooms[client.room]
+        members.discard(client)
 
-        await asyncio.gather(*(writer.drain() for writer in clients))
+        if not members:
+            del self.rooms[client.room]
 
-    # client connection callback
-    async def connection_cb(
-        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        client.room = None
+
+    def join(self, client: Recipient, room: str) -> None:
+        """Move `client` to `room`."""
+        self._leave(client)
+        self.rooms.setdefault(room, set()).add(client)
+        client.room = room
+
+    def members(self, room: str) -> abc.Set[Recipient]:
+        """Return the clients in `room`."""
+        return self.rooms.get(room, frozenset())
+
+
+class ServerState:
+    """State of a chat server, shared by its connections.
+
+    Stream connections are handled by `handle_stream`, transport level
+    connections by `ChatProtocol`. See `serve` for the arguments.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = QUEUE_SIZE,
+        overflow: Overflow = Overflow.DROP_OLDEST,
+        batch_size: int = BATCH_SIZE,
+        batch_delay: float = 0.0,
+        history: History | None = None,
+        limiter: RateLimiter | None = None,
+        metrics: Metrics | None = None,
+        idle_timeout: float | None = None,
+        heartbeat: float | None = None,
     ) -> None:
-        # handle login
-        login = Login.from_client(await reader.readline())
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.history = history if history is not None else History()
+        self.limiter = limiter
+        self.metrics = metrics
+        self.registry = Registry()
+        self.loop = asyncio.get_running_loop()
+
+        # the bus to the other servers, see `serve`
+        self.bus: asyncio.StreamWriter | None = None
+
+        # metrics
+        if metrics is not None:
+            self._instrument(metrics)
+
+        # idle clients
+        if heartbeat is not None and idle_timeout is None:
+            idle_timeout = 2 * heartbeat
+
+        self.idle_timeout = idle_timeout
+        self.heartbeat = heartbeat
+        self.wheel: TimerWheel | None = None
+
+        if idle_timeout is not None:
+            self.wheel = TimerWheel(min(TICK, idle_timeout / 10))
+            self.wheel.start()
+
+    def _instrument(self, metrics: Metrics) -> None:
+        registry = self.registry
+        self._counters = metrics.counters
+        self._broadcast_ns = metrics.histogram("broadcast_ns")
+        self._parse_ns = metrics.histogram("parse_ns")
+        metrics.gauges["clients"] = lambda: len(registry.clients)
+        metrics.gauges["rooms"] = lambda: len(registry.rooms)
+        metrics.gauges["queued"] = lambda: sum(
+            client.queued for client in registry.clients
+        )
+        metrics.gauges["queued_max"] = lambda: max(
+            (client.queued for client in registry.clients), default=0
+        )
+
+        if self.limiter is not None:
+            for name in ("admitted", "dropped", "delayed", "disconnected"):
+                metrics.gauges[f"flood_{name}"] = partial(getattr, self.limiter, name)
+
+    def close(self) -> None:
+        """Stop the timers and close the history."""
+        self.history.close()
+
+        if self.wheel is not None:
+            self.wheel.stop()
+
+    def connected(self, client: Recipient) -> None:
+        """Count `client` and disconnect it once idle, see `serve`."""
+        if self.metrics is not None:
+            self._counters["connections"] += 1
+
+        if self.wheel is not None:
+            assert self.idle_timeout is not None
+            client.active = self.loop.time()
+            self.wheel.schedule(
+                client,
+                self.heartbeat or self.idle_timeout,
+                partial(self.check_idle, client),
+            )
+
+    def disconnected(self, client: Recipient) -> None:
+        """Forget the timers of `client`."""
+        if self.wheel is not None:
+            self.wheel.cancel(client)
+
+    def check_idle(self, client: Recipient) -> None:
+        """Ping or disconnect `client` if idle, else check again later."""
+        assert self.wheel is not None and self.idle_timeout is not None
+        heartbeat = self.heartbeat
+        idle_timeout = self.idle_timeout
+
+        # its pongs are not read while it's held back
+        if client.delayed:
+            client.active = self.loop.time()
+
+        idle = self.loop.time() - client.active
+
+        if idle >= idle_timeout:
+            client.close()
+
+            if self.metrics is not None:
+                self._counters["idle_disconnects"] += 1
 
-        if login is None:
             return
 
+        if heartbeat is None:
+            delay = idle_timeout - idle
+        elif idle < heartbeat:
+            delay = heartbeat - idle
+        else:
+            client.send("", Ping().to_bytes())
+            delay = idle_timeout - idle
+
+            if self.metrics is not None:
+                self._counters["pings"] += 1
+
+        self.wheel.schedule(client, delay, partial(self.check_idle, client))
+
+    def enter(self, client: Recipient, room: str) -> None:
+        """Move `client` to `room` and replay its history."""
+        if client.room == room:
+            return
+
+        self.registry.join(client, room)
+        client.replay(self.history.frames(room))
+
+    def deliver(self, room: str, user: str, data: bytes) -> None:
+        """Send `data`, a message from `user`, to the clients in `room`."""
+        self.history.append(room, data)
+        members = self.registry.members(room)
+
+        for client in members:
+            client.send(user, data)
+
+        if self.metrics is not None:
+            self._counters["messages_out"] += len(members)
+            self._counters["bytes_out"] += len(members) * len(data)
+
+    def broadcast(self, room: str, user: str, data: bytes) -> None:
+        """Deliver `data`, a message from `user`, here and on other servers."""
+        if self.metrics is None:
+            self.deliver(room, user, data)
+        else:
+            start_time = time.perf_counter_ns()
+            self.deliver(room, user, data)
+            self._broadcast_ns.record(time.perf_counter_ns() - start_time)
+            self._counters["messages_in"] += 1
+
+        self.history.log(room, data)
+
+        if self.bus is not None:
+            self.bus.write(b"%s %s" % (room.encode(), data))
+
+    def bus_backed_up(self) -> bool:
+        """Check whether writes to the bus are backed up."""
+        if self.bus is None:
+            return False
+
+        transport = self.bus.transport
+        high_water = transport.get_write_buffer_limits()[1]
+        return transport.get_write_buffer_size() > high_water
+
+    def decode(
+        self, decoder: ClientDecoder, data: bytes
+    ) -> list[Login | Join | Pong | bytes | None]:
+        """Decode `data` with `decoder`, a line too long is an invalid frame."""
+        if self.metrics is None:
+            try:
+                return decoder.feed(data)
+            except ValueError:
+                return [None]
+
+        counters = self._counters
+        counters["bytes_in"] += len(data)
+        start_time = time.perf_counter_ns()
+
+        try:
+            frames = decoder.feed(data)
+        except ValueError:
+            frames = [None]
+
+        self._parse_ns.record(time.perf_counter_ns() - start_time)
+        counters["invalid_frames"] += frames.count(None)
+        return frames
+
+    async def handle_stream(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handle a client connection, see `asyncio.start_server`."""
+        registry = self.registry
+        history = self.history
+        limiter = self.limiter
+        wheel = self.wheel
+        decoder = ClientDecoder()
+        _set_nodelay(writer.transport)
+        client = Client(
+            writer,
+            self.queue_size,
+            self.overflow,
+            self.batch_size,
+            self.batch_delay,
+            self.metrics,
+        )
+
+        async def read_frames() -> list[Login | Join | Pong | bytes | None]:
+            data = await reader.read(READ_SIZE)
+
+            if wheel is not None:
+                client.active = self.loop.time()
+
+            if not data:
+                return [None]
+
+            return self.decode(decoder, data)
+
         # handle messages
-        with register_client(writer):
-            async for line in reader:
-                msg = Msg.from_client(login.user, line)
+        async def handle_messages(
+            login: Login, frames: list[Login | Join | Pong | bytes | None]
+        ) -> None:
+            buckets = limiter.buckets(login.user) if limiter is not None else []
 
-                if msg is None:
-                    break
+            try:
+                with registry.register(client):
+                    client.replay(history.frames(LOBBY))
 
-                await broadcast(msg)
+                    while True:
+                        for frame in frames:
+                            if isinstance(frame, bytes):
+                                if limiter is not None:
+                                    action, delay = limiter.check(buckets)
 
-    # serve
-    server = await asyncio.start_server(connection_cb, host, port)
-    async with server:
-        await server.serve_forever()
+                                    if action is Flood.DROP:
+                                        continue
+
+                                    if action is Flood.DISCONNECT:
+                                        return
+
+                                    while action is Flood.DELAY:
+                                        client.delayed = True
+                                        await asyncio.sleep(delay)
+
+                                        if writer.is_closing():
+                                            return
+
+                                        action, delay = limiter.check(buckets)
+
+                                    client.delayed = False
+
+                                assert client.room is not None
+                                self.broadcast(client.room, login.user, frame)
+                            elif isinstance(frame, Join):
+                                self.enter(client, frame.room)
+                            elif not isinstance(frame, Pong):
+                                return
+
+                        # read no more while the bus is backed up
+                        if self.bus is not None:
+                            client.delayed = True
+                            await self.bus.drain()
+                            client.delayed = False
+
+                        frames = await read_frames()
+            finally:
+                if limiter is not None:
+                    limiter.release(login.user)
+
+        self.connected(client)
+
+        # handle login
+        try:
+            frames: list[Login | Join | Pong | bytes | None] = []
+            while not frames:
+                frames = await read_frames()
+
+            login = frames.pop(0)
+
+            if isinstance(login, Login):
+                await handle_messages(login, frames)
+        finally:
+            client.close()
+            self.disconnected(client)
+
+    async def receive_bus(self, reader: asyncio.StreamReader) -> None:
+        """Deliver messages from other servers, "<room> msg <username> ..."."""
+        async for line in reader:
+            room, data = line.split(b" ", 1)
+            user = data.split(b" ", 2)[1]
+            self.deliver(room.decode(), user.decode(), data)
+
+
+class ChatProtocol(_Outbox, asyncio.Protocol):
+    """Chat connection on the transport level, alternative to `Client`.
+
+    Messages are written and queued as described in `_Outbox`, writing
+    is paused and resumed by the transport's flow control.
+    """
+
+    _transport: asyncio.Transport
+
+    def __init__(self, state: ServerState) -> None:
+        super().__init__(
+            state.queue_size, state.overflow, state.batch_size, state.batch_delay
+        )
+        self.state = state
+        self.room: str | None = None
+        self.active = state.loop.time()
+        self._decoder = ClientDecoder()
+        self._login: Login | None = None
+        self._buckets: list[TokenBucket] = []
+        self._delayed = False
+        self._bus_drained: asyncio.Task | None = None
+        self._paused_time = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self._transport = cast(asyncio.Transport, transport)
+        _set_nodelay(transport)
+        self.state.connected(self)
+
+    @property
+    def delayed(self) -> bool:
+        """Whether reading from the client is held back."""
+        return self._delayed or self._bus_drained is not None
+
+    def data_received(self, data: bytes) -> None:
+        state = self.state
+
+        if state.wheel is not None:
+            self.active = state.loop.time()
+
+        self._handle(state.decode(self._decoder, data))
+
+        # read no more until the bus has drained
+        if state.bus_backed_up() and self._bus_drained is None:
+            self._transport.pause_reading()
+            self._bus_drained = state.loop.create_task(self._wait_bus())
+
+    async def _wait_bus(self) -> None:
+        assert self.state.bus is not None
 
+        try:
+            await self.state.bus.drain()
+        except ConnectionError:  # serving ends with the relay
+            pass
+
+        self._bus_drained = None
+
+        if not self._delayed and not self._transport.is_closing():
+            self._transport.resume_reading()
+
+    def _handle(self, frames: list[Login | Join | Pong | bytes | None]) -> None:
+        state = self.state
+        limiter = state.limiter
+
+        if self._transport.is_closing():
+            return
+
+        for pos, frame in enumerate(frames):
+            if isinstance(frame, bytes) and self.room is not None:
+                assert self._login is not None
+
+                if limiter is not None:
+                    action, delay = limiter.check(self._buckets)
+
+                    if action is Flood.DROP:
+                        continue
+
+                    if action is Flood.DISCONNECT:
+                        self.close()
+                        return
+
+                    if action is Flood.DELAY:
+                        # stop reading until the rest can be handled
+                        self._delayed = True
+                        self._transport.pause_reading()
+                        state.loop.call_later(delay, self._handle, frames[pos:])
+                        return
+
+                state.broadcast(self.room, self._login.user, frame)
+            elif isinstance(frame, Join) and self._login is not None:
+                state.enter(self, frame.room)
+            elif isinstance(frame, Pong) and self._login is not None:
+                pass
+            elif isinstance(frame, Login) and self._login is None:
+                self._login = frame
+                state.registry.add(self)
+                self.replay(state.history.frames(LOBBY))
+
+                if limiter is not None:
+                    self._buckets = limiter.buckets(frame.user)
+            else:
+                self.close()
+                return
+
+        if self._delayed:
+            self._delayed = False
+
+            if self._bus_drained is None:
+                self._transport.resume_reading()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        state = self.state
+        state.disconnected(self)
+
+        if self._login is not None:
+            state.registry.remove(self)
+
+            if state.limiter is not None:
+                state.limiter.release(self._login.user)
+
+    def pause_writing(self) -> None:
+        self._paused = True
+
+        if self.state.metrics is not None:
+            self._paused_time = time.perf_counter_ns()
+
+    def resume_writing(self) -> None:
+        self._paused = False
+
+        if self.state.metrics is not None:
+            drain_ns = self.state.metrics.histogram("drain_ns")
+            drain_ns.record(time.perf_counter_ns() - self._paused_time)
+
+        self._write_queued()
+
+
+async def serve(
+    host: str,
+    port: int,
+    queue_size: int = QUEUE_SIZE,
+    overflow: Overflow = Overflow.DROP_OLDEST,
+    bus_path: str | None = None,
+    transport: bool = False,
+    batch_size: int = BATCH_SIZE,
+    batch_delay: float = 0.0,
+    history_size: int = HISTORY_SIZE,
+    history_path: str | None = None,
+    limiter: RateLimiter | None = None,
+    metrics: Metrics | None = None,
+    metrics_port: int | None = None,
+    idle_timeout: float | None = None,
+    heartbeat: float | None = None,
+) -> None:
+    """Serve chat server.
+
+    Every client has a send queue of `queue_size` messages, see
+    `Overflow` for what happens when it is full. Messages are coalesced
+    for up to `batch_delay` seconds, or `batch_size` messages, before
+    they are written.
+
+    The latest `history_size` messages of a room are sent to clients
+    entering it, and kept in the log file `history_path`, if given, to
+    survive restarts (see `History`). Servers connected to a bus only
+    read the log, the `relay` keeps it.
 
-async def _stdin_readline() -> str:
+    Messages from clients are rate limited by `limiter`, if given.
+
+    If `metrics` is given, or `metrics_port`, the server's counters,
+    gauges and latency histograms are kept in it, and served in plain
+    text on `metrics_port`, if given (see `serve_metrics`).
+
+    Clients that send nothing for `idle_timeout` seconds are
+    disconnected, and if `heartbeat` is given, clients are pinged after
+    `heartbeat` seconds (the idle timeout then defaults to twice that).
+
+    Connections are handled with streams, or if `transport` is true, by
+    `ChatProtocol` on the transport level.
+
+    If `bus_path` is given, the server shares `port` with other servers
+    and exchanges messages with them through the `relay` listening on
+    the unix socket `bus_path`, see `serve_workers`. Messages are never
+    dropped on their way to the other servers, instead no more is read
+    from clients while the bus is backed up.
+    """
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, sys.stdin.readline)
+
+    if metrics is None and metrics_port is not None:
+        metrics = Metrics()
+
+    state = ServerState(
+        queue_size=queue_size,
+        overflow=overflow,
+        batch_size=batch_size,
+        batch_delay=batch_delay,
+        history=History(history_size, history_path, read_only=bus_path is not None),
+        limiter=limiter,
+        metrics=metrics,
+        idle_timeout=idle_timeout,
+        heartbeat=heartbeat,
+    )
+
+    # serve
+    if transport:
+        server = await loop.create_server(
+            partial(ChatProtocol, state), host, port, reuse_port=bus_path is not None
+        )
+    else:
+        server = await asyncio.start_server(
+            state.handle_stream, host, port, reuse_port=bus_path is not None
+        )
+
+    if metrics is not None and metrics_port is not None:
+        metrics_server = serve_metrics(metrics, host, metrics_port)
+    else:
+        metrics_server = None
+
+    try:
+        if bus_path is None:
+            async with server:
+                await server.serve_forever()
+            return
+
+        bus_reader, state.bus = await asyncio.open_unix_connection(
+            bus_path, limit=BUS_LIMIT
+        )
+
+        # serve until the relay goes away
+        async with server:
+            await state.receive_bus(bus_reader)
+    finally:
+        state.close()
+
+        if metrics_server is not None:
+            # off the loop, which a request being rendered may wait for
+            await asyncio.to_thread(metrics_server.shutdown)
+            metrics_server.server_close()
+
+
+async def relay(path: str, history: History | None = None) -> asyncio.AbstractServer:
+    """Relay messages between the servers connected to unix socket `path`.
+
+    Returns the relay's server once it is listening, see
+    `asyncio.start_unix_server`.
+
+    No message is dropped, a server is not read from while the relay's
+    writes to any other server are backed up.
+
+    The messages are logged to `history`, if given, on behalf of all
+    the servers.
+    """
+    servers: set[asyncio.StreamWriter] = set()
+
+    async def connection_cb(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        servers.add(writer)
+
+        try:
+            async for line in reader:
+                if history is not None:
+                    room, _, data = line.partition(b" ")
+                    history.append(room.decode(), data)
+                    history.log(room.decode(), data)
+
+                others = [other for other in servers if other is not writer]
+
+                for other in others:
+                    other.write(line)
+
+                for other in others:
+                    try:
+                        await other.drain()
+                    except ConnectionError:  # removed by its own callback
+                        pass
+        finally:
+            servers.discard(writer)
+            writer.close()
+
+    return await asyncio.start_unix_server(connection_cb, path, limit=BUS_LIMIT)
+
+
+def _serve_worker(host: str, port: int, bus_path: str, kwargs: dict) -> None:
+    eventloops.run(serve(host, port, bus_path=bus_path, **kwargs))
+
+
+async def serve_workers(host: str, port: int, workers: int, **kwargs: Any) -> None:
+    """Serve chat server in `workers` processes sharing `port`.
+
+    The workers exchange messages through a `relay` run by this
+    process, which also keeps the history log, if any. See `serve` for
+    `kwargs`. Serving ends, with a RuntimeError, when a worker exits.
+    """
+    history_path = kwargs.get("history_path")
+    history = None
+
+    if history_path is not None:
+        history = History(kwargs.get("history_size", HISTORY_SIZE), history_path)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bus_path = os.path.join(tmp_dir, "bus.sock")
+        relay_server = await relay(bus_path, history)
+        ctx = mp.get_context("spawn")
+        processes = [
+            ctx.Process(
+                target=_serve_worker,
+                args=(host, port, bus_path, kwargs),
+                daemon=True,
+            )
+            for _ in range(workers)
+        ]
+
+        for process in processes:
+            process.start()
+
+        # serve until a worker exits
+        loop = asyncio.get_running_loop()
+        exited: asyncio.Future[mp.process.BaseProcess] = loop.create_future()
+
+        def worker_exited(process: mp.process.BaseProcess) -> None:
+            if not exited.done():
+                exited.set_result(process)
+
+        for process in processes:
+            loop.add_reader(process.sentinel, worker_exited, process)
+
+        try:
+            async with relay_server:
+                worker = await exited
+        finally:
+            for process in processes:
+                loop.remove_reader(process.sentinel)
+                process.terminate()
+
+            if history is not None:
+                history.close()
+
+        worker.join()
+        raise RuntimeError(f"worker {worker.pid} exited with code {worker.exitcode}")
 
 
 async def connect(host: str, port: int, user: str) -> None:
@@ -173,15 +1596,37 @@ async def connect(host: str, port: int, user: str) -> None:
     await writer.drain()
 
     # handlers
+    def frame(line: bytes) -> bytes:
+        if line[:6] == b"/join ":
+            return b"join %s\n" % line[6:]
+
+        return b"msg %s\n" % line
+
     async def handle_stdin() -> None:
-        while True:
-            line = await _stdin_readline()
-            writer.write(f"msg {line}".encode())
+        rest = b""
+
+        async for chunk in stdin_chunks():
+            data = rest + chunk
+            end = data.rfind(b"\n")
+            rest = data[end + 1 :]
+
+            if end >= 0:
+                writer.writelines([frame(line) for line in data[:end].split(b"\n")])
+                await writer.drain()
+
+        if rest:
+            writer.write(frame(rest))
             await writer.drain()
 
     async def handle_reader() -> None:
-        async for line in reader:
-            print(line.decode())
+        decoder = ServerDecoder()
+
+        while data := await reader.read(READ_SIZE):
+            for message in decoder.feed(data):
+                if isinstance(message, Ping):
+                    writer.write(Pong().to_bytes())
+                elif message is not None:
+                    print(message.to_bytes().decode())
 
     await asyncio.gather(handle_stdin(), handle_reader())
 
@@ -189,25 +1634,90 @@ async def connect(host: str, port: int, user: str) -> None:
 async def main() -> None:
     """Program entry point."""
     # parse arguments
-    prog = sys.argv.pop(0)
+    prog, *args = sys.argv
+    usage = (
+        f"usage: {prog} [-l LOOP] "
+        "[-s [-t] [-w WORKERS] [-b MICROSECONDS] [-H HISTORY_FILE] "
+        "[-r RATE [-a drop|delay|disconnect]] [-m METRICS_PORT] "
+        "[-i IDLE_TIMEOUT] [-p HEARTBEAT]]"
+    )
 
-    try:
-        sys.argv.remove("-s")
-    except ValueError:
-        client = True
-    else:
-        client = False
+    flags = {"-s": False, "-t": False}
+
+    for flag in flags:
+        try:
+            args.remove(flag)
+        except ValueError:
+            continue
+
+        flags[flag] = True
 
-    if sys.argv:
-        sys.exit(f"usage: {prog} [-s]")
+    parsers: dict[str, abc.Callable[[str], Any]] = {
+        "-w": int,
+        "-b": int,
+        "-H": str,
+        "-r": float,
+        "-a": Flood,
+        "-m": int,
+        "-i": float,
+        "-p": float,
+    }
+    options: dict[str, Any] = dict.fromkeys(parsers)
+
+    for option, parse in parsers.items():
+        try:
+            pos = args.index(option)
+        except ValueError:
+            continue
+
+        try:
+            options[option] = parse(args[pos + 1])
+        except (IndexError, ValueError):
+            sys.exit(usage)
+
+        del args[pos : pos + 2]
+
+    client = not flags["-s"]
+    workers = options["-w"] or 1
+
+    given = {option for option, value in options.items() if value is not None}
+
+    if args or (client and (flags["-t"] or given)):
+        sys.exit(usage)
+
+    # -a only goes along with -r, and the workers can't share the
+    # metrics port
+    if "-a" in given and "-r" not in given:
+        sys.exit(usage)
+
+    if "-m" in given and workers > 1:
+        sys.exit(usage)
 
     # start client or server
+    kwargs: dict[str, Any] = {
+        "transport": flags["-t"],
+        "batch_delay": (options["-b"] or 0) / 1_000_000,
+        "history_path": options["-H"],
+        "metrics_port": options["-m"],
+        "idle_timeout": options["-i"],
+        "heartbeat": options["-p"],
+    }
+
+    if options["-r"] is not None:
+        kwargs["limiter"] = RateLimiter(
+            options["-r"],
+            user_rate=options["-r"],
+            action=options["-a"] or Flood.DROP,
+        )
+
     if client:
-        user = input("username: ")
+        user = input_line("username: ")
         await connect(HOST, PORT, user)
+    elif workers > 1:
+        await serve_workers(HOST, PORT, workers, **kwargs)
     else:
-        await serve(HOST, PORT)
+        await serve(HOST, PORT, **kwargs)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    eventloops.run(main())
@@ -21,6 +21,9 @@ from contextlib import contextmanager
 from dataclasses import dataclass
 import sys
 
+from console import input_line, stdin_chunks
+import eventloops
+
 
 HOST = "localhost"
 PORT = 21213
@@ -69,11 +72,6 @@ async def serve(host: str, port: int) -> None:
         await server.serve_forever()
 
 
-async def _stdin_readline():
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, sys.stdin.readline)
-
-
 async def connect(host: str, port: int, user: str) -> None:
     """Connect to chat server."""
     reader, writer = await asyncio.open_connection(host, port)
@@ -84,9 +82,8 @@ async def connect(host: str, port: int, user: str) -> None:
     await writer.drain()
 
     async def handle_stdin():
-        while True:
-            line = await _stdin_readline()
-            writer.write(line.encode())
+        async for chunk in stdin_chunks():
+            writer.write(chunk)
             await writer.drain()
 
     async def handle_server_msg():
@@ -110,15 +107,15 @@ async def main() -> None:
         client = False
 
     if sys.argv:
-        sys.exit(f"usage: {prog} [-s]")
+        sys.exit(f"usage: {prog} [-l LOOP] [-s]")
 
     # start client or server
     if client:
-        user = input("username: ")
+        user = input_line("username: ")
         await connect(HOST, PORT, user)
     else:
         await serve(HOST, PORT)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    eventloops.run(main())
@@ -0,0 +1,66 @@
+"""Console input for the chat clients and nc.py."""
+
+from __future__ import annotations
+import asyncio
+from collections import abc
+import os
+import stat
+import sys
+import threading
+
+
+READ_SIZE = 64 * 1024
+
+
+def input_line(prompt: str) -> str:
+    """Like `input`, but stdin is never read beyond the line."""
+    if sys.stdin.isatty():
+        return input(prompt)
+
+    line = b""
+    while (byte := os.read(sys.stdin.fileno(), 1)) not in (b"", b"\n"):
+        line += byte
+
+    return line.decode()
+
+
+async def stdin_chunks(size: int = READ_SIZE) -> abc.AsyncIterator[bytes]:
+    """Yield chunks of data from stdin, until end of file.
+
+    Pipes and sockets are read by the event loop. Anything else, like a
+    terminal or a regular file, can't be polled or must not be made
+    non-blocking (stdout, sharing the terminal, would be too) and is
+    read in a thread of its own.
+    """
+    loop = asyncio.get_running_loop()
+    stdin = sys.stdin.buffer
+    mode = os.fstat(stdin.fileno()).st_mode
+
+    if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+        reader = asyncio.StreamReader(limit=size)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), stdin
+        )
+
+        while chunk := await reader.read(size):
+            yield chunk
+        return
+
+    chunks: asyncio.Queue[bytes] = asyncio.Queue(1)
+
+    # a daemon thread, blocked reading a terminal, doesn't hold up exit
+    def read() -> None:
+        chunk = b"-"
+
+        while chunk:
+            try:
+                chunk = os.read(stdin.fileno(), size)
+            except OSError:
+                chunk = b""
+
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+    threading.Thread(target=read, daemon=True).start()
+
+    while chunk := await chunks.get():
+        yield chunk
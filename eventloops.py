@@ -0,0 +1,92 @@
+"""Event loop selection.
+
+The event loop is chosen by name, with the `-l NAME` command line
+option or the CHAT_LOOP environment variable:
+
+    asyncio       the standard library loop (default)
+    uvloop        uvloop, which must be installed
+    auto          uvloop if it is installed, otherwise asyncio
+    MODULE:NAME   custom event loop policy class, or factory, NAME in MODULE
+
+The chat servers are benchmarked in a given loop with chat_bench.py:
+
+    python chat_bench.py -l uvloop -s complete
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import abc
+import importlib
+import os
+import socket
+import sys
+from typing import Any, TypeVar
+
+
+LOOP_ENV = "CHAT_LOOP"
+
+T = TypeVar("T")
+
+
+def loop_policy(name: str) -> asyncio.AbstractEventLoopPolicy:
+    """Return event loop policy called `name`."""
+    if name == "auto":
+        try:
+            importlib.import_module("uvloop")
+        except ImportError:
+            name = "asyncio"
+        else:
+            name = "uvloop"
+
+    if name == "asyncio":
+        return asyncio.DefaultEventLoopPolicy()
+
+    if name == "uvloop":
+        name = "uvloop:EventLoopPolicy"
+
+    module_name, sep, attr = name.partition(":")
+
+    if not sep:
+        raise ValueError(f"unknown event loop {name!r}")
+
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+def _pop_loop_arg() -> str | None:
+    try:
+        pos = sys.argv.index("-l", 1)
+    except ValueError:
+        return None
+
+    try:
+        name = sys.argv[pos + 1]
+    except IndexError:
+        sys.exit(f"{sys.argv[0]}: -l requires a loop name")
+
+    del sys.argv[pos : pos + 2]
+    return name
+
+
+def run(main: abc.Coroutine[Any, Any, T]) -> T:
+    """Run `main` in the selected event loop.
+
+    The `-l NAME` option is removed from `sys.argv` and stored in the
+    environment, so that subprocesses use the same loop.
+    """
+    name = _pop_loop_arg() or os.environ.get(LOOP_ENV, "asyncio")
+    os.environ[LOOP_ENV] = name
+
+    try:
+        asyncio.set_event_loop_policy(loop_policy(name))
+    except (ImportError, AttributeError, ValueError) as exc:
+        main.close()
+        sys.exit(f"{sys.argv[0]}: event loop {name!r} unavailable: {exc}")
+
+    return asyncio.run(main)
+
+
+def free_port(host: str) -> int:
+    """Return a TCP port on `host` that is free to listen on."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
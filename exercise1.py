@@ -7,6 +7,9 @@ from itertools import islice
 import re
 
 
+_XML_TAG_RE = re.compile(r"<[^>]*>")
+
+
 def ends_match(strings: abc.Iterable[str]) -> int:
     """Count strings in `strings` where ends match.
 
@@ -119,8 +122,13 @@ def strip_xml_tags(text: str) -> str:
 
     >>> strip_xml_tags('Vi kan <a href="python.org">Python</a>!')
     'Vi kan Python!'
+
+    Tags may span several lines.
+
+    >>> strip_xml_tags('<p\\nclass="x">Text</p>')
+    'Text'
     """
-    return re.sub(r"<.*?>", "", text)
+    return _XML_TAG_RE.sub("", text)
 
 
 if __name__ == "__main__":
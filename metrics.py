@@ -0,0 +1,161 @@
+"""Server metrics: counters, gauges and histograms.
+
+`Metrics` are rendered as plain text, a "<name> <value>" line per value,
+and can be served over HTTP with `serve_metrics`:
+
+    $ curl http://localhost:21214/
+    bytes_in 1290
+    ...
+    broadcast_ns_p50 1792
+    broadcast_ns_p99 10752
+    ...
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import Counter, abc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+
+
+RENDER_TIMEOUT = 5.0
+
+
+class Histogram:
+    """Histogram of non-negative integers, such as latencies.
+
+    Values are counted in buckets with a relative width of at most
+    1 / 2**`precision`, like in HdrHistogram, so the memory used is
+    logarithmic in the range of the values.
+
+    >>> histogram = Histogram()
+    >>> for value in range(1, 1001):
+    ...     histogram.record(value)
+    >>> histogram.count, histogram.percentile(50), histogram.max
+    (1000, 496, 1000)
+    """
+
+    def __init__(self, precision: int = 5) -> None:
+        self.precision = precision
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        """Count `value`."""
+        shift = value.bit_length() - self.precision - 1
+
+        if shift > 0:
+            bucket = (shift << self.precision) + (value >> shift)
+        else:
+            bucket = value
+
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+
+        if value > self.max:
+            self.max = value
+
+    def _lowest(self, bucket: int) -> int:
+        shift = (bucket >> self.precision) - 1
+
+        if shift > 0:
+            return (bucket - (shift << self.precision)) << shift
+
+        return bucket
+
+    def percentile(self, percent: float) -> int:
+        """Return the (lowest value in the bucket of the) `percent` percentile."""
+        rank = self.count * percent / 100
+        seen = 0
+
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+
+            if seen >= rank:
+                return self._lowest(bucket)
+
+        return 0
+
+
+class Metrics:
+    """Named counters, gauges and histograms.
+
+    Gauges are functions returning the current value, called when the
+    metrics are rendered.
+
+    >>> metrics = Metrics()
+    >>> metrics.counters["messages"] += 2
+    >>> metrics.gauges["clients"] = lambda: 1
+    >>> metrics.histogram("latency").record(10)
+    >>> print(metrics.render())
+    messages 2
+    clients 1
+    latency_count 1
+    latency_p50 10
+    latency_p99 10
+    latency_p999 10
+    latency_max 10
+    <BLANKLINE>
+    """
+
+    def __init__(self) -> None:
+        self.counters: Counter[str] = Counter()
+        self.gauges: dict[str, abc.Callable[[], float]] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def histogram(self, name: str) -> Histogram:
+        """Return histogram `name`, created if need be."""
+        histogram = self.histograms.get(name)
+
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+
+        return histogram
+
+    def render(self) -> str:
+        """Return metrics as plain text."""
+        lines = [f"{name} {value}" for name, value in sorted(self.counters.items())]
+        lines.extend(f"{name} {gauge()}" for name, gauge in sorted(self.gauges.items()))
+
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f"{name}_count {histogram.count}")
+            lines.append(f"{name}_p50 {histogram.percentile(50)}")
+            lines.append(f"{name}_p99 {histogram.percentile(99)}")
+            lines.append(f"{name}_p999 {histogram.percentile(99.9)}")
+            lines.append(f"{name}_max {histogram.max}")
+
+        return "".join(f"{line}\n" for line in lines)
+
+
+def serve_metrics(metrics: Metrics, host: str, port: int) -> HTTPServer:
+    """Serve `metrics` on http://`host`:`port`/ from a thread of its own.
+
+    The metrics are rendered in the running event loop, which updates
+    them. Call `shutdown` on the returned server to stop serving.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def render() -> str:
+        return metrics.render()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Metrics request handler."""
+
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            """Handle GET."""
+            future = asyncio.run_coroutine_threadsafe(render(), loop)
+            body = future.result(RENDER_TIMEOUT).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            # pylint: disable=redefined-builtin
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,21 +1,184 @@
+"""Send stdin to a server, or replay a capture of traffic to it.
+
+    python nc.py HOST PORT
+    python nc.py -r CAPTURE [-c CONNECTIONS] [-f] [-p PRELUDE] HOST PORT
+
+A capture has a line of traffic per line, prefixed by the time it was
+sent, in seconds, and a tab: "<seconds>\\t<line>". The lines are sent
+round-robin over CONNECTIONS connections, at the captured pace or with
+-f as fast as possible. PRELUDE, with {} replaced by the connection
+number, is sent first on every connection, e.g. -p "login user{}".
+"""
+
 import asyncio
 import sys
+import time
+
+from console import stdin_chunks
+import eventloops
+
+
+READ_SIZE = 64 * 1024
+
+
+def _records(lines):
+    records = []
+
+    for line in lines:
+        seconds, _, line = line.partition(b"\t")
+
+        try:
+            records.append((float(seconds), line + b"\n"))
+        except ValueError:
+            continue
+
+    return records
+
+
+def _capture_records(capture_file):
+    rest = b""
+
+    for chunk in iter(lambda: capture_file.read(READ_SIZE), b""):
+        data = rest + chunk
+        end = data.rfind(b"\n")
+        rest = data[end + 1 :]
+
+        if end >= 0:
+            yield _records(data[:end].split(b"\n"))
+
+    # last line, without newline
+    if rest:
+        yield _records([rest])
+
+
+async def replay(host, port, capture_path, connections=1, timed=True, prelude=None):
+    streams = await asyncio.gather(
+        *(asyncio.open_connection(host, port) for _ in range(connections))
+    )
+    writers = [writer for _, writer in streams]
+    received = 0
+
+    async def receive(reader):
+        nonlocal received
+        while data := await reader.read(READ_SIZE):
+            received += len(data)
+
+    receivers = [asyncio.create_task(receive(reader)) for reader, _ in streams]
+
+    if prelude is not None:
+        for num, writer in enumerate(writers):
+            writer.write(prelude.replace("{}", str(num)).encode() + b"\n")
 
+    # send lines round-robin, written together per connection
+    batches = [[] for _ in writers]
+    sent = 0
+    sent_bytes = 0
 
-async def _stdin_readline():
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, sys.stdin.readline)
+    async def flush():
+        nonlocal sent_bytes
+        for writer, batch in zip(writers, batches):
+            if batch:
+                writer.writelines(batch)
+                sent_bytes += sum(map(len, batch))
+                batch.clear()
+
+        for writer in writers:
+            await writer.drain()
+
+    start_time = time.perf_counter()
+    first_seconds = None
+
+    with open(capture_path, "rb") as capture_file:
+        for records in _capture_records(capture_file):
+            for seconds, line in records:
+                if timed:
+                    if first_seconds is None:
+                        first_seconds = seconds
+
+                    elapsed = time.perf_counter() - start_time
+                    delay = seconds - first_seconds - elapsed
+
+                    if delay > 0:
+                        await flush()
+                        await asyncio.sleep(delay)
+
+                batches[sent % connections].append(line)
+                sent += 1
+
+            await flush()
+
+    elapsed = time.perf_counter() - start_time
+
+    for writer in writers:
+        writer.close()
+
+    for task in receivers:
+        task.cancel()
+
+    print(
+        f"sent {sent} lines, {sent_bytes} bytes in {elapsed:.2f} s: "
+        f"{sent / elapsed:.0f} lines/s, {sent_bytes / elapsed / 1e6:.1f} MB/s, "
+        f"received {received} bytes",
+        file=sys.stderr,
+    )
 
 
 async def main():
-    host, port = sys.argv[1:]
+    prog, *args = sys.argv
+    usage = (
+        f"usage: {prog} [-l LOOP] "
+        "[-r CAPTURE [-c CONNECTIONS] [-f] [-p PRELUDE]] HOST PORT"
+    )
+    options = {"-r": None, "-c": "1", "-p": None}
+
+    for option in options:
+        try:
+            pos = args.index(option)
+        except ValueError:
+            continue
+
+        try:
+            options[option] = args[pos + 1]
+        except IndexError:
+            sys.exit(usage)
+
+        del args[pos : pos + 2]
+
+    try:
+        args.remove("-f")
+    except ValueError:
+        timed = True
+    else:
+        timed = False
+
+    if len(args) != 2 or not options["-c"].isdigit() or int(options["-c"]) < 1:
+        sys.exit(usage)
+
+    if options["-r"] is None and (options["-c"] != "1" or options["-p"] or not timed):
+        sys.exit(usage)
+
+    host, port = args
+
+    if options["-r"] is not None:
+        await replay(
+            host,
+            port,
+            options["-r"],
+            connections=int(options["-c"]),
+            timed=timed,
+            prelude=options["-p"],
+        )
+        return
+
     reader, writer = await asyncio.open_connection(host, port)
 
-    while True:
-        line = await _stdin_readline()
-        writer.write(line.encode())
+    async for chunk in stdin_chunks():
+        writer.write(chunk)
         await writer.drain()
 
+    writer.close()
+    await writer.wait_closed()
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    eventloops.run(main())
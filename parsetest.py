@@ -0,0 +1,46 @@
+import asyncio
+import re
+import time
+
+from chat_complete import READ_SIZE, ClientDecoder
+
+SERVER_RE = re.compile(rb"msg (.*)\n")
+
+
+async def stream_reader_regex(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+
+    frames = []
+    async for line in reader:
+        match = SERVER_RE.match(line)
+        frames.append(b"msg bob %d %s\n" % (int(time.time()), match.group(1)))
+
+    return frames
+
+
+async def client_decoder(data):
+    decoder = ClientDecoder()
+    frames = decoder.feed(b"login bob\n")
+
+    for pos in range(0, len(data), READ_SIZE):
+        frames.extend(decoder.feed(data[pos : pos + READ_SIZE]))
+
+    return frames
+
+
+async def main():
+    count = 1_000_000
+    data = b"msg hello everybody, how are you doing today?\n" * count
+
+    for parse in (stream_reader_regex, client_decoder):
+        start_time = time.time()
+        await parse(data)
+        end_time = time.time()
+
+        print(f"{parse.__name__}: {count / (end_time - start_time):.0f} messages/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
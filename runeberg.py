@@ -1,21 +1,83 @@
 """Project Runeberg parsing exercise."""
 
 from __future__ import annotations
-from collections import abc, defaultdict
-from itertools import chain, tee
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, abc, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import heapq
+from itertools import accumulate, chain, islice, repeat
+import math
+import mmap
+from operator import itemgetter
+import os
 from pathlib import Path
+import pickle
 import random
-import re
+import struct
 import sys
-from typing import TypeVar
+from typing import Any, AnyStr, Literal, Protocol, TypeVar, overload
 
 
-def _strip_xml_tags(text: str) -> str:
-    return re.sub(r"<.*?>", "", text)
+_CHUNK_SIZE = 64 * 1024
 
+# number of words fed to consumers at a time by `aggregate`
+_WORD_CHUNK_SIZE = 64 * 1024
 
-def runeberg_words(path: Path) -> abc.Iterable[str]:
-    """Generate words from the Project Runeberg text in `path`."""
+CACHE_DIR_NAME = ".runeberg-cache"
+
+# magic, chapter mtime (ns), chapter size, chapter digest, vocabulary size
+# (bytes) and number of words, followed by the newline separated utf-8
+# vocabulary and the little endian uint32 vocabulary index of every word
+_CACHE_HEADER = struct.Struct("<4sqq32sQQ")
+_CACHE_MAGIC = b"RBW1"
+
+
+class TagStripper:
+    """Streaming XML tag stripper.
+
+    Whether the previous chunk ended inside a tag is remembered, so
+    tags may span chunk (and line) boundaries.
+
+    >>> stripper = TagStripper()
+    >>> stripper.feed('Vi kan <a href=')
+    'Vi kan '
+    >>> stripper.feed('"python.org">Python</a>!')
+    'Python!'
+    """
+
+    def __init__(self) -> None:
+        self._in_tag = False
+
+    def feed(self, chunk: str) -> str:
+        """Return `chunk` stripped of xml tags."""
+        find = chunk.find
+        parts = []
+        pos = 0
+
+        if self._in_tag:
+            pos = find(">") + 1
+
+            if not pos:
+                return ""
+
+            self._in_tag = False
+
+        while (start := find("<", pos)) >= 0:
+            parts.append(chunk[pos:start])
+            pos = find(">", start) + 1
+
+            if not pos:
+                self._in_tag = True
+                return "".join(parts)
+
+        parts.append(chunk[pos:])
+        return "".join(parts)
+
+
+def _chapter_paths(path: Path) -> abc.Iterable[Path]:
+    """Generate the chapter paths listed in `path`/Articles.lst."""
 
     def articles_lines() -> abc.Iterable[str]:
         with open(path / "Articles.lst", "r", encoding="utf-8") as article_file:
@@ -25,87 +87,1048 @@ def runeberg_words(path: Path) -> abc.Iterable[str]:
         line.split("|")[0] for line in articles_lines() if not line.startswith("#")
     )
 
-    chapter_paths = ((path / basename).with_suffix(".html") for basename in basenames)
+    return ((path / basename).with_suffix(".html") for basename in basenames)
 
-    def book_lines() -> abc.Iterable[str]:
-        for chapter_path in chapter_paths:
-            with open(chapter_path, "r", encoding="utf-8") as chapter_file:
-                yield from chapter_file
 
-    without_tags = (_strip_xml_tags(line) for line in book_lines())
+def _chapter_words(chapter_path: Path) -> abc.Iterable[str]:
+    """Generate words from the chapter in `chapter_path`."""
+    stripper = TagStripper()
+    rest = ""
 
-    book_words = chain.from_iterable(book_line.split() for book_line in without_tags)
+    with open(chapter_path, "r", encoding="utf-8") as chapter_file:
+        while chunk := chapter_file.read(_CHUNK_SIZE):
+            text = rest + stripper.feed(chunk)
+            words = text.split()
 
-    # Here we could add more steps to the pipeline, i.e.
+            # the last word may continue in the next chunk
+            rest = words.pop() if text and not text[-1].isspace() else ""
 
-    # casefolded = (word.casefold() for word in book_words)
-    # without_punctuation = (word.strip('.,:;-*') for word in casefolded)
-    # without_empty = (word for word in without_punctuation if word)
+            yield from words
 
-    yield from book_words
+    if rest:
+        yield rest
 
 
-def word_count(words: abc.Iterable[str]) -> int:
-    """Count the words in `words`."""
-    return sum(1 for _ in words)
+def _chapter_digest(chapter_path: Path) -> bytes:
+    return hashlib.blake2s(chapter_path.read_bytes()).digest()
 
 
-def top_ten(words: abc.Iterable[str]) -> list[tuple[str, int]]:
-    """Top ten words in `words`."""
-    word_counts = defaultdict(int)
+def _write_token_cache(
+    cache_path: Path, stat: os.stat_result, digest: bytes, words: list[str]
+) -> None:
+    vocabulary: dict[str, int] = {}
+    indices = array(
+        "I", (vocabulary.setdefault(word, len(vocabulary)) for word in words)
+    )
+    vocabulary_data = "\n".join(vocabulary).encode()
 
-    for word in words:
-        word_counts[word] += 1
+    if sys.byteorder == "big":
+        indices.byteswap()
 
-    return sorted(word_counts.items(), key=lambda v: -v[1])[:10]
+    header = _CACHE_HEADER.pack(
+        _CACHE_MAGIC,
+        stat.st_mtime_ns,
+        stat.st_size,
+        digest,
+        len(vocabulary_data),
+        len(indices),
+    )
 
+    # write atomically, concurrent readers see the old or the new cache
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as cache_file:
+        cache_file.write(header)
+        cache_file.write(vocabulary_data)
+        cache_file.write(indices.tobytes())
 
-T = TypeVar("T")
+    os.replace(tmp_path, cache_path)
 
 
-def _pairwise(itr: abc.Iterable[T]) -> abc.Iterable[tuple[T, T]]:
-    original, advanced = tee(itr)
-    next(advanced)
-    return zip(original, advanced)
+def _cached_chapter_words(chapter_path: Path, cache_dir: Path) -> list[str]:
+    """Return words from the chapter in `chapter_path` using a token cache.
 
+    The chapter is only tokenized again when its content has changed
+    since it was cached in `cache_dir`, it is not even read as long as
+    its mtime and size are unchanged.
+    """
+    cache_path = cache_dir / f"{chapter_path.name}.words"
+    stat = chapter_path.stat()
 
-def random_walk(words: abc.Iterable[str], num: int) -> str:
-    """Random walk through `words`."""
-    word_continuations = defaultdict(list)
+    try:
+        data = cache_path.read_bytes()
+        magic, mtime_ns, size, digest, vocabulary_size, num_words = (
+            _CACHE_HEADER.unpack_from(data)
+        )
+    except (FileNotFoundError, struct.error):
+        magic = None
+
+    if magic == _CACHE_MAGIC and size == stat.st_size:
+        valid = mtime_ns == stat.st_mtime_ns
+
+        if not valid and digest == _chapter_digest(chapter_path):
+            # touched but unchanged, refresh the stored mtime
+            valid = True
+            header = _CACHE_HEADER.pack(
+                magic, stat.st_mtime_ns, size, digest, vocabulary_size, num_words
+            )
+            with open(cache_path, "r+b") as cache_file:
+                cache_file.write(header)
+
+        if valid:
+            start = _CACHE_HEADER.size
+            indices = array("I")
+
+            try:
+                vocabulary = data[start : start + vocabulary_size].decode().split("\n")
+                indices.frombytes(data[start + vocabulary_size :])
+
+                if sys.byteorder == "big":
+                    indices.byteswap()
+
+                if len(indices) == num_words:
+                    return [vocabulary[index] for index in indices]
+            except (UnicodeDecodeError, ValueError, IndexError):
+                pass  # corrupt cache, rebuild it
+
+    words = list(_chapter_words(chapter_path))
+    _write_token_cache(cache_path, stat, _chapter_digest(chapter_path), words)
+    return words
+
+
+def _load_chapter_words(
+    chapter_path: Path, cache_dir: Path | None
+) -> abc.Iterable[str]:
+    if cache_dir is None:
+        return _chapter_words(chapter_path)
+
+    return _cached_chapter_words(chapter_path, cache_dir)
+
+
+Normalizer = abc.Callable[[str], str]
+
+PUNCTUATION = ".,:;-*!?\"'()[]«»–—…"
+
+
+def casefold(word: str) -> str:
+    """Casefold `word`."""
+    return word.casefold()
+
+
+def strip_punctuation(word: str) -> str:
+    """Strip leading and trailing `PUNCTUATION` from `word`."""
+    return word.strip(PUNCTUATION)
+
+
+def normalized(
+    words: abc.Iterable[str], normalizers: abc.Sequence[Normalizer]
+) -> abc.Iterable[str]:
+    """Generate `words` passed through each of the `normalizers` in turn.
+
+    All normalizers are applied to a word in a single step, rather than
+    stacking a generator per normalizer. Words that are normalized to
+    the empty string are dropped.
+
+    >>> list(normalized(['Jag', '-', 'sade:'], [casefold, strip_punctuation]))
+    ['jag', 'sade']
+    """
+    if not normalizers:
+        yield from words
+    elif len(normalizers) == 1:
+        (normalizer,) = normalizers
+        yield from filter(None, map(normalizer, words))
+    else:
+        for word in words:
+            for normalizer in normalizers:
+                word = normalizer(word)
+
+                if not word:
+                    break
+            else:
+                yield word
+
+
+def runeberg_words(
+    path: Path,
+    cache_dir: Path | None = None,
+    normalizers: abc.Sequence[Normalizer] = (),
+) -> abc.Iterable[str]:
+    """Generate words from the Project Runeberg text in `path`.
+
+    If `cache_dir` is given, the words of every chapter are cached there
+    and reused as long as the chapter is unchanged. The words are
+    normalized by `normalizers`, see `normalized`.
+    """
+    if cache_dir is not None:
+        cache_dir.mkdir(exist_ok=True)
+
+    book_words = chain.from_iterable(
+        _load_chapter_words(chapter_path, cache_dir)
+        for chapter_path in _chapter_paths(path)
+    )
+
+    yield from normalized(book_words, normalizers)
+
+
+def _mmap_chapter_words(
+    chapter_path: Path, decode: abc.Callable[[bytes], AnyStr]
+) -> abc.Iterable[AnyStr]:
+    with open(chapter_path, "rb") as chapter_file:
+        if not os.fstat(chapter_file.fileno()).st_size:
+            return
+
+        with mmap.mmap(chapter_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            find = buffer.find
+            empty = decode(b"")
+            rest = empty
+            pos = 0
+
+            while True:
+                start = find(b"<", pos)
+                segment = buffer[pos:start] if start >= 0 else buffer[pos:]
+                text = rest + decode(segment)
+                words = text.split()
+
+                # the last word may continue after the tag
+                rest = words.pop() if text and not text[-1:].isspace() else empty
+
+                yield from words
+
+                if start < 0:
+                    break
+
+                pos = find(b">", start) + 1
+
+                if not pos:
+                    break
+
+            if rest:
+                yield rest
+
+
+@overload
+def mmap_words(path: Path, as_bytes: Literal[False] = ...) -> abc.Iterable[str]:
+    ...
+
+
+@overload
+def mmap_words(path: Path, as_bytes: Literal[True]) -> abc.Iterable[bytes]:
+    ...
+
+
+def mmap_words(path: Path, as_bytes: bool = False) -> abc.Iterable[str | bytes]:
+    """Generate words from the Project Runeberg text in `path`.
+
+    Like `runeberg_words` but every chapter is memory mapped and scanned
+    for tags as bytes, only the text between tags is copied out of the
+    mapping. That text is utf-8 decoded unless `as_bytes` is true, note
+    that only ASCII whitespace separates words in that case.
+    """
+    for chapter_path in _chapter_paths(path):
+        if as_bytes:
+            yield from _mmap_chapter_words(chapter_path, bytes)
+        else:
+            yield from _mmap_chapter_words(chapter_path, bytes.decode)
+
+
+class WordConsumer(Protocol):
+    """Consumer of a word stream, see `aggregate`."""
+
+    def update(self, words: abc.Sequence[str]) -> None:
+        """Consume every word in `words`, in order."""
+
+
+_Consumer = TypeVar("_Consumer", bound="MergeableConsumer")
+
+
+class MergeableConsumer(WordConsumer, Protocol):
+    """Consumer that can be fed in parts, see `aggregate_chapters`."""
+
+    def merge(self: _Consumer, other: _Consumer) -> None:
+        """Merge `other`, fed with the words following ours, into `self`."""
+
+
+def aggregate(words: abc.Iterable[str], *consumers: WordConsumer) -> None:
+    """Feed every word in `words` to all `consumers` in a single pass.
+
+    The words are fed in chunks of up to `_WORD_CHUNK_SIZE` words to the
+    `update` method of every consumer.
+    """
+    words = iter(words)
+    updaters = [consumer.update for consumer in consumers]
+
+    while chunk := list(islice(words, _WORD_CHUNK_SIZE)):
+        for update in updaters:
+            update(chunk)
+
+
+def _chapter_partials(
+    chapter_paths: abc.Sequence[Path],
+    templates: bytes,
+    cache_dir: Path | None,
+    normalizers: abc.Sequence[Normalizer],
+) -> list[MergeableConsumer]:
+    consumers = pickle.loads(templates)
+    words = chain.from_iterable(
+        _load_chapter_words(chapter_path, cache_dir) for chapter_path in chapter_paths
+    )
+    aggregate(normalized(words, normalizers), *consumers)
+    return consumers
+
+
+def _split_chapters(chapter_paths: list[Path], num: int) -> list[list[Path]]:
+    """Split `chapter_paths` into at most `num` runs of about equal size."""
+    if not chapter_paths:
+        return []
+
+    sizes = list(accumulate(path.stat().st_size for path in chapter_paths))
+    ends = [bisect_left(sizes, sizes[-1] * part // num) + 1 for part in range(1, num)]
+    ends.append(len(chapter_paths))
+
+    return [
+        chapter_paths[start:end] for start, end in zip([0, *ends], ends) if start < end
+    ]
+
+
+def aggregate_chapters(
+    path: Path,
+    *consumers: MergeableConsumer,
+    max_workers: int | None = None,
+    cache_dir: Path | None = None,
+    normalizers: abc.Sequence[Normalizer] = (),
+) -> None:
+    """Feed the words of the Project Runeberg text in `path` to `consumers`.
+
+    The chapters are split into one run of consecutive chapters per
+    worker in a pool of `max_workers` processes. Each run is parsed and
+    aggregated by a worker, the partial results are then merged into
+    `consumers` in chapter order. The `consumers` must be empty when
+    passed to this function since they are copied to the workers.
+
+    See `runeberg_words` for `cache_dir` and `normalizers`, the latter
+    must be picklable.
+    """
+    templates = pickle.dumps(consumers)
+    num_workers = max_workers or os.cpu_count() or 1
+
+    if cache_dir is not None:
+        cache_dir.mkdir(exist_ok=True)
+
+    runs = _split_chapters(list(_chapter_paths(path)), num_workers)
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        for partials in executor.map(
+            _chapter_partials,
+            runs,
+            repeat(templates),
+            repeat(cache_dir),
+            repeat(normalizers),
+        ):
+            for consumer, partial in zip(consumers, partials):
+                consumer.merge(partial)
+
+
+INDEX_FILE_NAME = "index.pickle"
+
+
+def _store_index(index_path: Path, index: dict[str, Any]) -> None:
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as index_file:
+        pickle.dump(index, index_file, pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, index_path)
+
+
+def aggregate_incremental(
+    path: Path,
+    *consumers: MergeableConsumer,
+    index_path: Path,
+    cache_dir: Path | None = None,
+    normalizers: abc.Sequence[Normalizer] = (),
+) -> None:
+    """Feed the words of the Project Runeberg text in `path` to `consumers`.
+
+    The partial results of every chapter, and their aggregate, are
+    stored in the index at `index_path`. On later calls only chapters
+    that are new or have changed (by mtime or size) are parsed. If
+    chapters were only appended to Articles.lst, their partial results
+    are merged into the stored aggregate, otherwise the stored partial
+    results are merged anew. The `consumers` must be empty, see
+    `aggregate_chapters` which also describes the other arguments.
+    """
+    templates = pickle.dumps(consumers)
+    signature = pickle.dumps((consumers, normalizers))
+
+    try:
+        with open(index_path, "rb") as index_file:
+            index = pickle.load(index_file)
+    except (
+        FileNotFoundError,
+        # truncated, or written by other versions of the consumers
+        EOFError,
+        pickle.UnpicklingError,
+        AttributeError,
+        ImportError,
+    ):
+        index = None
+
+    if index is None or index["signature"] != signature:
+        index = {"signature": signature, "chapters": [], "partials": {}}
+
+    if cache_dir is not None:
+        cache_dir.mkdir(exist_ok=True)
+
+    chapters = []
+    partials = {}
+
+    for chapter_path in _chapter_paths(path):
+        stat = chapter_path.stat()
+        key = (chapter_path.name, stat.st_mtime_ns, stat.st_size)
+        chapters.append(key)
+
+        if key not in partials:
+            partials[key] = index["partials"].get(key) or _chapter_partials(
+                [chapter_path], templates, cache_dir, normalizers
+            )
+
+    previous = index["chapters"]
+
+    if previous and chapters[: len(previous)] == previous:
+        totals = index["totals"]
+        added = chapters[len(previous) :]
+    else:
+        totals = pickle.loads(templates)
+        added = chapters
+
+    for key in added:
+        for total, partial in zip(totals, partials[key]):
+            total.merge(partial)
+
+    if added or chapters != previous:
+        _store_index(
+            index_path,
+            {
+                "signature": signature,
+                "chapters": chapters,
+                "partials": partials,
+                "totals": totals,
+            },
+        )
+
+    for consumer, total in zip(consumers, totals):
+        consumer.merge(total)
+
+
+class WordCount:
+    """Word counting consumer."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def add(self, word: str) -> None:
+        """Count `word`."""
+        self.count += 1
 
-    for word, after in _pairwise(words):
-        word_continuations[word].append(after)
+    def update(self, words: abc.Sequence[str]) -> None:
+        """Count every word in `words`."""
+        self.count += len(words)
 
-    res = [random.choice(list(word_continuations.keys()))]
+    def merge(self, other: WordCount) -> None:
+        """Add the count of `other`."""
+        self.count += other.count
 
-    for _ in range(num):
-        res.append(random.choice(word_continuations[res[-1]]))
 
-    return " ".join(res)
+class WordFrequencies:
+    """Word frequency table consumer."""
+
+    def __init__(self) -> None:
+        self.counts: Counter[str] = Counter()
+
+    def add(self, word: str) -> None:
+        """Count an occurrence of `word`."""
+        self.counts[word] += 1
+
+    def update(self, words: abc.Sequence[str]) -> None:
+        """Count an occurrence of every word in `words`."""
+        self.counts.update(words)
+
+    def merge(self, other: WordFrequencies) -> None:
+        """Add the counts of `other`."""
+        self.counts.update(other.counts)
+
+    def top(self, num: int) -> list[tuple[str, int]]:
+        """Return the `num` most frequent words with their counts."""
+        return heapq.nlargest(num, self.counts.items(), key=itemgetter(1))
+
+
+class SpaceSaving:
+    """Approximate word frequency table consumer with bounded memory.
+
+    At most `capacity` words are counted using the Space-Saving
+    algorithm: a new word replaces the least frequent one and inherits
+    its count. Counts are therefore overestimated, by at most
+    `errors[word]` which in turn is at most the number of consumed words
+    divided by `capacity`. Every word more frequent than that is
+    guaranteed to be counted.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        # (count, word) for every counted word, the counts may be stale
+        self._heap: list[tuple[int, str]] = []
+
+    def add(self, word: str) -> None:
+        """Count an occurrence of `word`."""
+        counts = self.counts
+
+        if word in counts:
+            counts[word] += 1
+        elif len(counts) < self.capacity:
+            counts[word] = 1
+            self.errors[word] = 0
+            heapq.heappush(self._heap, (1, word))
+        else:
+            count, victim = self._least_frequent()
+            del counts[victim], self.errors[victim]
+            counts[word] = count + 1
+            self.errors[word] = count
+            heapq.heapreplace(self._heap, (count + 1, word))
+
+    def update(self, words: abc.Sequence[str]) -> None:
+        """Count an occurrence of every word in `words`."""
+        for word in words:
+            self.add(word)
+
+    def _least_frequent(self) -> tuple[int, str]:
+        heap = self._heap
+
+        # counts only grow, so an up to date top is the minimum
+        while heap[0][0] != self.counts[heap[0][1]]:
+            word = heap[0][1]
+            heapq.heapreplace(heap, (self.counts[word], word))
+
+        return heap[0]
+
+    def merge(self, other: SpaceSaving) -> None:
+        """Add the counts of `other`.
+
+        A word missing from a full table may have occurred as often as
+        its least frequent word, so that count is added to the count and
+        error bound of such words.
+
+        >>> first, second = SpaceSaving(2), SpaceSaving(2)
+        >>> aggregate('aaabc', first)
+        >>> aggregate('bbd', second)
+        >>> first.merge(second)
+        >>> first.counts, first.errors
+        ({'a': 4, 'b': 4}, {'a': 1, 'b': 2})
+        """
+        counts, errors = defaultdict(int, self.counts), defaultdict(int, self.errors)
+
+        for table, others in ((self, other), (other, self)):
+            if len(table.counts) >= table.capacity:
+                missing, _ = table._least_frequent()
+
+                for word in others.counts.keys() - table.counts.keys():
+                    counts[word] += missing
+                    errors[word] += missing
+
+        for word, count in other.counts.items():
+            counts[word] += count
+            errors[word] += other.errors[word]
+
+        self.counts = dict(
+            heapq.nlargest(self.capacity, counts.items(), key=itemgetter(1))
+        )
+        self.errors = {word: errors[word] for word in self.counts}
+        self._heap = [(count, word) for word, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def top(self, num: int) -> list[tuple[str, int]]:
+        """Return the `num` most frequent words with their counts."""
+        return heapq.nlargest(num, self.counts.items(), key=itemgetter(1))
+
+
+# word indices are packed into integers, `_INDEX_BITS` bits per word, so
+# states are plain integers rather than tuples
+_INDEX_BITS = 32
+_INDEX_MASK = (1 << _INDEX_BITS) - 1
+
+
+def _pack(indices: abc.Iterable[int]) -> int:
+    """Return the word `indices` packed into an integer."""
+    key = 0
+
+    for index in indices:
+        key = key << _INDEX_BITS | index
+
+    return key
+
+
+def _unpack(keys: abc.Iterable[int], order: int) -> array[int]:
+    """Return the `order` word indices packed into each of `keys`, in order."""
+    keys = list(keys)
+    digits = [
+        [key >> _INDEX_BITS * power & _INDEX_MASK for key in keys]
+        for power in range(order - 1, -1, -1)
+    ]
+    return array("I", chain.from_iterable(zip(*digits)))
+
+
+class Continuations:
+    """N-gram table consumer, records the words following each state.
+
+    A state is the `order` words preceding a word. Words are interned,
+    i.e. `vocabulary` maps each word to an integer index, and so are
+    states: the id of a state of order 1 is the index of its word, the
+    states of higher orders, their word indices packed into an integer
+    (see `_pack`), are given ids by `states`. `continuations[state_id]`
+    is an array of the indices of the words that followed the state.
+
+    The first `order` words have no state, their indices are kept in
+    `head` so `merge` can record them as continuations of the last
+    words of the table they are merged into.
+    """
+
+    def __init__(self, order: int = 1) -> None:
+        self.order = order
+        self.vocabulary: dict[str, int] = {}
+        self.states: dict[int, int] = {}
+        self.continuations: list[array[int]] = []
+        self.head = array("I")
+        # the last `order` words, packed
+        self._state = 0
+        # all but the oldest word of a state
+        self._rest_mask = (1 << _INDEX_BITS * (order - 1)) - 1
+
+    def add(self, word: str) -> None:
+        """Record `word` as a continuation of the previous words."""
+        self.update((word,))
+
+    def update(self, words: abc.Iterable[str]) -> None:
+        """Record every word in `words` as by `add`, in a tighter loop."""
+        vocabulary = self.vocabulary
+        self._record([vocabulary.setdefault(word, len(vocabulary)) for word in words])
+
+    def _record(self, indices: abc.Iterable[int]) -> None:
+        order = self.order
+        head = self.head
+        continuations = self.continuations
+        rest_mask = self._rest_mask
+        state = self._state
+        indices = iter(indices)
+
+        for index in islice(indices, max(0, order - len(head))):
+            head.append(index)
+            state = (state & rest_mask) << _INDEX_BITS | index
+
+        if order == 1:
+            continuations.extend(
+                array("I") for _ in range(len(self.vocabulary) - len(continuations))
+            )
+
+            for index in indices:
+                continuations[state].append(index)
+                state = index
+        else:
+            states = self.states
+
+            for index in indices:
+                state_id = states.get(state)
+
+                if state_id is None:
+                    states[state] = len(continuations)
+                    continuations.append(array("I", (index,)))
+                else:
+                    continuations[state_id].append(index)
+
+                state = (state & rest_mask) << _INDEX_BITS | index
+
+        self._state = state
+
+    def merge(self, other: Continuations) -> None:
+        """Add the continuations of `other`, joined at our last words."""
+        if not self.head:
+            # nothing to join, take over the words of `other`
+            self.vocabulary = dict(other.vocabulary)
+            self.states = dict(other.states)
+            self.continuations = [
+                array("I", targets) for targets in other.continuations
+            ]
+            self.head = array("I", other.head)
+            self._state = other._state
+            return
+
+        if not other.head:
+            return
+
+        vocabulary = self.vocabulary
+        continuations = self.continuations
+        order = self.order
+        indices = [
+            vocabulary.setdefault(word, len(vocabulary)) for word in other.vocabulary
+        ]
+        shifts = range(_INDEX_BITS * (order - 1), -1, -_INDEX_BITS)
+
+        def remapped(state: int) -> int:
+            return _pack(indices[state >> shift & _INDEX_MASK] for shift in shifts)
+
+        # the first words of `other` continue our last words
+        self._record([indices[index] for index in other.head])
+
+        if order == 1:
+            state_ids = indices
+        else:
+            states = self.states
+            state_ids = []
+
+            for state in other.states:
+                state = remapped(state)
+                state_id = states.get(state)
+
+                if state_id is None:
+                    state_id = states[state] = len(continuations)
+                    continuations.append(array("I"))
+
+                state_ids.append(state_id)
+
+        for state_id, targets in zip(state_ids, other.continuations):
+            continuations[state_id].extend(map(indices.__getitem__, targets))
+
+        if len(other.head) == order:
+            self._state = remapped(other._state)
+
+    def model(self) -> MarkovModel:
+        """Return a compact Markov model of the table."""
+        continuations = self.continuations
+
+        if self.order == 1:
+            states: abc.Sequence[int] = range(len(continuations))
+        else:
+            states = sorted(self.states)
+            continuations = [continuations[self.states[state]] for state in states]
+
+        return MarkovModel.from_continuations(
+            list(self.vocabulary), self.order, states, continuations
+        )
+
+
+# magic, order, vocabulary size (bytes), number of states, number of
+# transitions and the typecodes of the offsets and weights, followed by
+# the newline separated utf-8 vocabulary and the little endian states,
+# offsets, targets and weights arrays
+_MODEL_HEADER = struct.Struct("<4sIQQQ2s")
+_MODEL_MAGIC = b"RBM2"
+
+
+class MarkovModel:
+    """Markov model of order `order` for random walks.
+
+    State `i` is the word indices `states[i * order:(i + 1) * order]`,
+    the states are sorted so a state is looked up with a binary search
+    of `_keys`, the first two words of every state packed together.
+    Its continuations are stored, CSR style, as the
+    `targets[offsets[i]:offsets[i + 1]]` word indices with the running
+    sums of their counts in `weights`, so a continuation can be sampled
+    with a binary search too.
+    """
+
+    def __init__(
+        self,
+        order: int,
+        words: list[str],
+        states: array[int],
+        offsets: array[int],
+        targets: array[int],
+        weights: array[int],
+    ) -> None:
+        self.order = order
+        self.words = words
+        self.states = states
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+
+        if order == 1:
+            self._keys = states
+        else:
+            self._keys = array(
+                "Q",
+                [
+                    first << _INDEX_BITS | second
+                    for first, second in zip(states[::order], states[1::order])
+                ],
+            )
+
+    @classmethod
+    def from_continuations(
+        cls,
+        words: list[str],
+        order: int,
+        states: abc.Sequence[int],
+        continuations: abc.Sequence[abc.Sequence[int]],
+    ) -> MarkovModel:
+        """Construct `cls` from the `continuations` of sorted `states`.
+
+        The states are packed into integers, see `_pack`, and
+        `continuations[i]` are the indices of the words that followed
+        `states[i]`, see `Continuations`.
+        """
+        # offsets and weights are at most the number of transitions
+        num_transitions = sum(map(len, continuations))
+        typecode = "I" if num_transitions <= _INDEX_MASK else "Q"
+        keys = []
+        offsets = array(typecode, [0])
+        targets = array("I")
+        weights = array(typecode)
+
+        for key, state_targets in zip(states, continuations):
+            if not state_targets:
+                continue
+
+            counts = Counter(state_targets)
+            keys.append(key)
+            targets.extend(counts)
+            # the running sums restart from zero at every state
+            weights.extend(accumulate(counts.values()))
+            offsets.append(len(targets))
+
+        return cls(order, words, _unpack(keys, order), offsets, targets, weights)
+
+    @classmethod
+    def from_words(cls, words: abc.Iterable[str], order: int = 1) -> MarkovModel:
+        """Construct `cls` from `words`."""
+        continuations = Continuations(order)
+        aggregate(words, continuations)
+        return continuations.model()
+
+    def _arrays(self) -> tuple[array[int], ...]:
+        return self.states, self.offsets, self.targets, self.weights
+
+    def save(self, path: Path) -> None:
+        """Save model to `path`."""
+        vocabulary_data = "\n".join(self.words).encode()
+        header = _MODEL_HEADER.pack(
+            _MODEL_MAGIC,
+            self.order,
+            len(vocabulary_data),
+            len(self.offsets) - 1,
+            len(self.targets),
+            (self.offsets.typecode + self.weights.typecode).encode(),
+        )
+
+        with open(path, "wb") as model_file:
+            model_file.write(header)
+            model_file.write(vocabulary_data)
+
+            for data in self._arrays():
+                if sys.byteorder == "big":
+                    data = array(data.typecode, data)
+                    data.byteswap()
+
+                model_file.write(data.tobytes())
+
+    @classmethod
+    def load(cls, path: Path) -> MarkovModel:
+        """Load model saved to `path`.
+
+        >>> import tempfile
+        >>> model = MarkovModel.from_words('a rose is a rose'.split(), order=2)
+        >>> with tempfile.TemporaryDirectory() as tmp_dir:
+        ...     model.save(Path(tmp_dir) / 'model')
+        ...     loaded = MarkovModel.load(Path(tmp_dir) / 'model')
+        >>> loaded.order, loaded.words
+        (2, ['a', 'rose', 'is'])
+        >>> loaded._arrays() == model._arrays()
+        True
+        """
+        data = path.read_bytes()
+        magic, order, vocabulary_size, num_states, num_transitions, typecodes = (
+            _MODEL_HEADER.unpack_from(data)
+        )
+
+        if magic != _MODEL_MAGIC:
+            raise ValueError(f"{path} is not a Markov model")
+
+        offsets_typecode, weights_typecode = typecodes.decode()
+        pos = _MODEL_HEADER.size
+        words = data[pos : pos + vocabulary_size].decode().split("\n")
+        pos += vocabulary_size
+
+        arrays = []
+        for typecode, length in (
+            ("I", num_states * order),
+            (offsets_typecode, num_states + 1),
+            ("I", num_transitions),
+            (weights_typecode, num_transitions),
+        ):
+            values = array(typecode)
+            end = pos + length * values.itemsize
+            values.frombytes(data[pos:end])
+            pos = end
+
+            if sys.byteorder == "big":
+                values.byteswap()
+
+            arrays.append(values)
+
+        return cls(order, words, *arrays)
+
+    def _state_words(self, number: int) -> list[int]:
+        return self.states[number * self.order : (number + 1) * self.order].tolist()
+
+    def _find(self, state: list[int]) -> int | None:
+        """Return the number of the state of word indices `state`, if any."""
+        order = self.order
+        key = state[0] if order == 1 else state[0] << _INDEX_BITS | state[1]
+        lo = bisect_left(self._keys, key)
+        hi = bisect_right(self._keys, key, lo)
+        states = self.states
+
+        # narrow the states sharing the first two words down by the rest
+        for pos in range(2, order):
+            if lo == hi:
+                break
+
+            column = range(pos, len(states), order)
+            word = state[pos]
+            lo = bisect_left(column, word, lo, hi, key=states.__getitem__)
+            hi = bisect_right(column, word, lo, hi, key=states.__getitem__)
+
+        return lo if lo < hi else None
+
+    def _random_state(self) -> int:
+        return random.randrange(len(self.offsets) - 1)
+
+    def walk(self, num: int) -> str:
+        """Random walk of `num` steps through the model.
+
+        The walk starts over from a random state at the end of the text.
+
+        >>> MarkovModel.from_words('a b c d'.split(), order=3).walk(6)
+        'a b c d a b c d a'
+        """
+        order = self.order
+        first = self._random_state()
+        index: int | None = first
+        res = self._state_words(first)
+
+        while len(res) < order + num:
+            if index is None:
+                # dead end, i.e. the last words of the text
+                index = self._random_state()
+                res.extend(self._state_words(index))
+                continue
+
+            lo, hi = self.offsets[index], self.offsets[index + 1]
+            pick = random.randrange(self.weights[hi - 1])
+            res.append(self.targets[bisect_right(self.weights, pick, lo, hi)])
+            index = self._find(res[-order:])
+
+        return " ".join([self.words[word] for word in res[: order + num]])
+
+
+def word_count(words: abc.Iterable[str]) -> int:
+    """Count the words in `words`."""
+    return sum(1 for _ in words)
+
+
+def top_k(
+    words: abc.Iterable[str], k: int, error: float | None = None
+) -> list[tuple[str, int]]:
+    """Top `k` words in `words`.
+
+    The words are counted exactly unless `error` is given, then at most
+    max(`k`, 1 / `error`) words are counted, see `SpaceSaving`. Each
+    count may be overestimated by up to `error` times the number of
+    words, and every word occurring more often than that is among the
+    top `k` words unless `k` words occur more often still.
+
+    >>> top_k(list('aaaaabbbccd'), 10, error=0.5)
+    [('a', 5), ('b', 3), ('c', 2), ('d', 1)]
+    """
+    if error is not None and not 0 < error <= 1:
+        raise ValueError(f"error must be in (0, 1], not {error!r}")
+
+    frequencies: WordFrequencies | SpaceSaving = (
+        WordFrequencies()
+        if error is None
+        else SpaceSaving(max(k, math.ceil(1 / error)))
+    )
+    aggregate(words, frequencies)
+    return frequencies.top(k)
+
+
+def top_ten(words: abc.Iterable[str]) -> list[tuple[str, int]]:
+    """Top ten words in `words`."""
+    return top_k(words, 10)
+
+
+def random_walk(words: abc.Iterable[str], num: int) -> str:
+    """Random walk through `words`."""
+    return MarkovModel.from_words(words).walk(num)
 
 
 def main() -> None:
     """Program entry point."""
 
     # parse arguments
+    prog, *args = sys.argv
+    flags = {arg for arg in args if arg in ("-j", "-i", "-c", "-m", "-n")}
+
     try:
-        path_str = sys.argv[1]
-    except IndexError:
-        sys.exit(f"Usage: python {sys.argv[0]} PATH")
+        (path_str,) = (arg for arg in args if arg not in flags)
+    except ValueError:
+        sys.exit(f"Usage: python {prog} [-j | -i | -m] [-c] [-n] PATH")
 
     path = Path(path_str)
+    parallel = "-j" in flags
+    cache_dir = path / CACHE_DIR_NAME if "-c" in flags else None
+    normalizers = (casefold, strip_punctuation) if "-n" in flags else ()
+
+    # collect statistics in a single pass over the corpus
+    count, frequencies, continuations = WordCount(), WordFrequencies(), Continuations()
+
+    if parallel:
+        aggregate_chapters(
+            path,
+            count,
+            frequencies,
+            continuations,
+            cache_dir=cache_dir,
+            normalizers=normalizers,
+        )
+    elif "-i" in flags:
+        index_dir = path / CACHE_DIR_NAME
+        index_dir.mkdir(exist_ok=True)
+        aggregate_incremental(
+            path,
+            count,
+            frequencies,
+            continuations,
+            index_path=index_dir / INDEX_FILE_NAME,
+            cache_dir=cache_dir,
+            normalizers=normalizers,
+        )
+    elif "-m" in flags:
+        words = normalized(mmap_words(path), normalizers)
+        aggregate(words, count, frequencies, continuations)
+    else:
+        words = runeberg_words(path, cache_dir, normalizers)
+        aggregate(words, count, frequencies, continuations)
 
     # count words
-    print(f'\nWords in "{path}": {word_count(runeberg_words(path))}')
+    print(f'\nWords in "{path}": {count.count}')
 
     # report top ten
     print("\nTop ten words:")
-    for word, count in top_ten(runeberg_words(path)):
-        print(f"\t{word}:\t{count}")
+    for word, occurrences in frequencies.top(10):
+        print(f"\t{word}:\t{occurrences}")
 
     # random walk
     print("\nRandom walk:")
-    print(random_walk(runeberg_words(path), 100))
+    print(continuations.model().walk(100))
 
 
 if __name__ == "__main__":
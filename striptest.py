@@ -0,0 +1,40 @@
+from pathlib import Path
+import re
+import sys
+import time
+
+from runeberg import TagStripper, _CHUNK_SIZE, _chapter_paths
+
+
+def regex_lines(chapter_path):
+    with open(chapter_path, "r", encoding="utf-8") as chapter_file:
+        return [re.sub(r"<.*?>", "", line) for line in chapter_file]
+
+
+def stripper_chunks(chapter_path):
+    stripper = TagStripper()
+    with open(chapter_path, "r", encoding="utf-8") as chapter_file:
+        return [
+            stripper.feed(chunk)
+            for chunk in iter(lambda: chapter_file.read(_CHUNK_SIZE), "")
+        ]
+
+
+def main():
+    path = Path(sys.argv[1] if len(sys.argv) > 1 else "doktorglas")
+    chapter_paths = list(_chapter_paths(path))
+    rounds = 20
+
+    for strip in (regex_lines, stripper_chunks):
+        start_time = time.time()
+
+        for _ in range(rounds):
+            for chapter_path in chapter_paths:
+                strip(chapter_path)
+
+        end_time = time.time()
+        print(f"{strip.__name__}: {(end_time - start_time) / rounds} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Tests of chat_complete.py serving clients that read nothing.
+
+Run with `python -m pytest test_chat_complete.py`, every scenario is
+run by both `ServerState.handle_stream` and `ChatProtocol`, in each
+event loop that is installed.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import abc
+from functools import partial
+
+import pytest
+
+from chat_complete import HISTORY_SIZE, LOBBY, ChatProtocol, Overflow, ServerState
+import eventloops
+
+
+LOOPS = ["asyncio", "uvloop"]
+
+
+@pytest.fixture(params=LOOPS)
+def runner(request: pytest.FixtureRequest) -> abc.Iterator[asyncio.Runner]:
+    """Runner of the event loop called `request.param`."""
+    if request.param == "uvloop":
+        pytest.importorskip("uvloop")
+
+    policy = eventloops.loop_policy(request.param)
+
+    with asyncio.Runner(loop_factory=policy.new_event_loop) as run:
+        yield run
+
+
+async def stuck_client(
+    make_state: abc.Callable[[], ServerState],
+    transport: bool,
+    stall: abc.Callable[[ServerState, asyncio.StreamWriter], abc.Awaitable[None]],
+) -> tuple[int, int]:
+    """Return clients logged in before and after `stall`.
+
+    A client logs in, to a lobby whose history does not fit in the
+    socket buffers, and then reads nothing while `stall` runs, which
+    may write to the server.
+    """
+    state = make_state()
+
+    for _ in range(HISTORY_SIZE):
+        state.history.append(LOBBY, b"msg a 0 %s\n" % (b"a" * 60000))
+
+    loop = asyncio.get_running_loop()
+
+    if transport:
+        server = await loop.create_server(partial(ChatProtocol, state), "127.0.0.1", 0)
+    else:
+        server = await asyncio.start_server(state.handle_stream, "127.0.0.1", 0)
+
+    _, writer = await asyncio.open_connection(
+        "127.0.0.1", server.sockets[0].getsockname()[1]
+    )
+    writer.write(b"login stuck\n")
+    await asyncio.sleep(0.2)
+    logged_in = len(state.registry.clients)
+    await stall(state, writer)
+    writer.close()
+    server.close()
+    state.close()
+    return logged_in, len(state.registry.clients)
+
+
+async def overflow(state: ServerState, _writer: asyncio.StreamWriter) -> None:
+    """Send more messages than fit in the queue of a client."""
+    for _ in range(11):
+        state.deliver(LOBBY, "a", b"msg a 0 a\n")
+
+    await asyncio.sleep(0.2)
+
+
+async def idle(state: ServerState, _writer: asyncio.StreamWriter) -> None:
+    """Wait until a client is idle for longer than allowed."""
+    await asyncio.sleep(1.0)
+
+
+async def join_flood(state: ServerState, writer: asyncio.StreamWriter) -> None:
+    """Switch rooms, each time replaying the history of the lobby."""
+    writer.write(b"join dev\njoin lobby\n" * 10)
+    await asyncio.sleep(0.2)
+
+
+@pytest.mark.parametrize("transport", [False, True])
+def test_overflow_disconnects(runner: asyncio.Runner, transport: bool) -> None:
+    make_state = partial(ServerState, queue_size=10, overflow=Overflow.DISCONNECT)
+    assert runner.run(stuck_client(make_state, transport, overflow)) == (1, 0)
+
+
+@pytest.mark.parametrize("transport", [False, True])
+def test_idle_disconnects(runner: asyncio.Runner, transport: bool) -> None:
+    make_state = partial(ServerState, idle_timeout=0.5)
+    assert runner.run(stuck_client(make_state, transport, idle)) == (1, 0)
+
+
+@pytest.mark.parametrize("transport", [False, True])
+def test_join_flood_disconnects(runner: asyncio.Runner, transport: bool) -> None:
+    make_state = partial(ServerState, queue_size=10, overflow=Overflow.DISCONNECT)
+    assert runner.run(stuck_client(make_state, transport, join_flood)) == (1, 0)